@@ -1,29 +1,131 @@
 import json
+import threading
+from collections import OrderedDict
 
 import config
 import redis
 
+_redis_client = None
 
-class Cache:
-    def __init__(self):
-        self.redis_client = redis.Redis(
+
+# returns the redis client shared by the caches of this process.
+# the client keeps a connection pool, which redis-py resets in forked processes by itself.
+def get_redis_client() -> redis.Redis:
+    global _redis_client
+
+    if _redis_client is None:
+        _redis_client = redis.Redis(
             host=config.redis_host,
             port=config.redis_port,
             password=config.redis_pass,
         )
 
-    def save(self, key: str, value: dict):
+    return _redis_client
+
+
+class Cache:
+    def __init__(self):
+        self.redis_client = get_redis_client()
+
+    # expiry in seconds, None to keep forever
+    def save(self, key: str, value: dict, expiry=None):
 
-        print(f'saved to cached key : {key} \n value: {value}')
+        print(f'saved to cached key : {key} \n value: {str(value)[:200]}')
 
-        self.redis_client.set(key, json.dumps(value))
+        self.redis_client.set(key, json.dumps(value), ex=expiry)
 
     def retrieve(self, key: str) -> dict:
         result = self.redis_client.get(key)
 
-        print(f'retrieved from cache key : {key} \n result: {result}')
+        print(f'retrieved from cache key : {key} \n result: {str(result)[:200]}')
 
         if result is None:
             return {}
 
         return json.loads(result)
+
+    def delete(self, key: str):
+        print(f'deleted cached key : {key}')
+
+        self.redis_client.delete(key)
+
+
+class ResultRegistry:
+    """Registry of the results outstanding at AIT. Results registered here are polled by result_poller.py
+        An entry is a dict {"result_uuid", "snapshot_uuid", "infrared_project_json", "task_id", "group_id", "deadline"}
+    """
+    key = "outstanding_results"
+
+    def __init__(self):
+        self.redis_client = get_redis_client()
+
+    def register(self, entry: dict):
+        self.redis_client.hset(self.key, entry["result_uuid"], json.dumps(entry))
+
+    def get_all(self) -> list:
+        return [json.loads(entry) for entry in self.redis_client.hgetall(self.key).values()]
+
+    # removes an entry. Returns False if it was already removed (e.g. by another poller).
+    def claim(self, result_uuid: str) -> bool:
+        return self.redis_client.hdel(self.key, result_uuid) == 1
+
+
+class GroupProgressChannel:
+    """Redis pub/sub channels of group tasks. Workers publish an event once a tile of the group is finished.
+        An event is a dict {"taskId", "state"}
+    """
+    prefix = "group_progress_"
+
+    def __init__(self):
+        self.redis_client = get_redis_client()
+
+    def publish(self, grouptask_id: str, event: dict):
+        self.redis_client.publish(self.prefix + grouptask_id, json.dumps(event))
+
+    # returns a subscription to the events of the group. Events are read with get_message(), close() when done.
+    def subscribe(self, grouptask_id: str):
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.prefix + grouptask_id)
+
+        return pubsub
+
+
+class TileCache:
+    """Cache of encoded map tiles (bytes)
+        - a bounded in-process LRU tier for the tiles requested most
+        - a shared redis tier with expiry
+    """
+    def __init__(self, max_size=config.tile_cache_size):
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.redis_client = get_redis_client()
+
+    # returns the tile or None. Tiles without results are cached as empty bytes, in the in-process tier only.
+    def get(self, key: str):
+        with self._lock:
+            tile = self._lru.get(key)
+            if tile is not None:
+                self._lru.move_to_end(key)
+                return tile
+
+        tile = self.redis_client.get(key)
+        if tile is not None:
+            self._put_to_lru(key, tile)
+
+        return tile
+
+    # expiry in seconds, None to keep forever.
+    # empty tiles are not shared: any tile far off the results would be stored in redis otherwise.
+    def save(self, key: str, tile: bytes, expiry=None):
+        self._put_to_lru(key, tile)
+        if tile:
+            self.redis_client.set(key, tile, ex=expiry)
+
+    def _put_to_lru(self, key, tile):
+        with self._lock:
+            self._lru[key] = tile
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
@@ -17,6 +17,31 @@ broker_url = 'redis://:{}@{}:{}/0'.format(
 # Worker config
 worker_concurrency = 10
 
+# Merged results of group tasks, as served by /collect_results
+merged_result_partial_expiry = int(os.getenv('MERGED_RESULT_PARTIAL_EXPIRY', 60 * 60))  # seconds, while tiles are missing
+merged_result_final_expiry = int(os.getenv('MERGED_RESULT_FINAL_EXPIRY', 7 * 24 * 60 * 60))  # seconds, once all tiles are done
+# Buildings synced to the infrared projects, remembered to skip syncing unchanged buildings
+buildings_sync_expiry = int(os.getenv('BUILDINGS_SYNC_EXPIRY', 30 * 24 * 60 * 60))  # seconds a sync is remembered
+
+# PNG results, as served by /collect_results
+png_max_pixels = int(os.getenv('PNG_MAX_PIXELS', 4096 * 4096))  # upper limit of width * height of an image
+
+# Map tiles of results, as served by /results/<grouptask_id>/tiles
+tile_cache_size = int(os.getenv('TILE_CACHE_SIZE', 1024))  # tiles kept in memory of each api process
+
+# Group tasks, whose ids are handed out by the api before compute_task saved the group
+group_dispatch_expiry = int(os.getenv('GROUP_DISPATCH_EXPIRY', 24 * 60 * 60))  # seconds the dispatch state is kept
+
+# Progress events of group tasks, as streamed by /collect_results/<grouptask_id>/events
+sse_max_duration = int(os.getenv('SSE_MAX_DURATION', 5 * 60))  # seconds until a stream is closed. Clients reconnect.
+sse_keepalive_interval = int(os.getenv('SSE_KEEPALIVE_INTERVAL', 15))  # seconds between keepalive comments
+
+# Result polling
+# if enabled, results at AIT are polled by the result_poller.py service instead of the celery workers
+result_poller_enabled = os.getenv('RESULT_POLLER', 'false').lower() == 'true'
+result_poller_request_budget = int(os.getenv('RESULT_POLLER_REQUEST_BUDGET', 8))  # concurrent requests to AIT
+result_poller_request_timeout = float(os.getenv('RESULT_POLLER_REQUEST_TIMEOUT', 20))  # seconds until a poll is given up
+
 # Result config
 result_expires = None  # never expire
 result_persistent = True
@@ -1,29 +1,51 @@
 import os
+import math
+import time
+import json
+import base64
+import geopandas
 
-from flask import Flask, request, abort, make_response, jsonify
+from flask import Flask, Response, request, abort, make_response, jsonify
 from flask_compress import Compress
 from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth
 from http import HTTPStatus
 
 from celery_app import app as celery_app
-from celery.result import AsyncResult, GroupResult
+from celery.result import AsyncResult
+from celery.utils import uuid
 
 import werkzeug
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
-from services import check_infrared_projects_still_exist_at_infrared, get_buildings_geojson_from_cityPyo, get_infrared_projects_from_group_task, convert_result_to_png, hash_dict
-from wind.data import summarize_multiple_geojsons_to_one
+from services import check_infrared_projects_still_exist_at_infrared, get_buildings_geojson_from_cityPyo, get_infrared_projects_from_group_task, convert_result_to_png, hash_dict, \
+    get_infrared_projects_from_group, find_cached_calculation, find_cached_project_setup, announce_group_dispatch, \
+    get_cache_key_merged_result, get_cache_key_merge_state, get_cache_key_result_tile, convert_result_to_columnar, GroupSnapshot, \
+    get_cache_key_compute_task
+from geojson_to_png import palettes, image_formats, is_valid_tile, render_result_tile
+from gdf_to_columnar import columnar_formats
+from geojson_to_mvt import get_result_polygon_index, render_result_vector_tile
+from wind.data import get_result_polygons, summarize_tile_results, fold_tile_results_into_mosaic, import_global_grid_block, convert_raster_to_geojson
+from cache import Cache, TileCache, GroupProgressChannel
+import config
 import tasks
 
 
 app = Flask(__name__)
 CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
+mvt_content_type = "application/vnd.mapbox-vector-tile"
+app.config["COMPRESS_MIMETYPES"] = [
+    'text/html', 'text/css', 'text/xml', 'application/json', 'application/javascript', mvt_content_type,
+    'application/flatgeobuf', 'application/vnd.apache.arrow.file'
+]
 Compress(app)
 
 auth = HTTPBasicAuth()
+cache = Cache()
+tile_cache = TileCache()
+progress_channel = GroupProgressChannel()
 
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_PASSWORD = os.getenv('CLIENT_PASSWORD')
@@ -70,41 +92,40 @@ def bad_request(exception: werkzeug.exceptions.BadRequest):
 # tries to find the calculation result in cache and returns its group task id
 # otherwise returns None
 def find_calc_task_in_cache(sim_type:str, buildings_hash: str, calc_settings_hash:str) -> str:
-    try:
+    group_task_id = find_cached_calculation(sim_type, buildings_hash, calc_settings_hash)
 
-        calc_task = tasks.get_result_from_cache.delay(sim_type, buildings_hash, calc_settings_hash)
-    except Exception:
+    if group_task_id is None:
         print("Result not yet in cache")
         return None
 
-    print("found group task for calculation in cache. Task ID", calc_task.id)
-
-    try:
-        async_result = AsyncResult(calc_task.id, app=celery_app)
-        group_result = GroupResult.restore(async_result.get(), app=celery_app)
-
-        # test if result can be restored
-        _result_array = [result.get() for result in group_result.results if result.ready()]
+    print("found group task for calculation in cache. Group task ID", group_task_id)
 
-        return group_result.id
-
-    except Exception as e:
-        print("But obtaining results from cache caused error.", e)
+    # test if result can be restored
+    group_snapshot = GroupSnapshot.restore(group_task_id, with_results=False)
+    if group_snapshot is None or group_snapshot.failed():
+        print("But obtaining results from cache caused error.")
         return None
 
+    return group_task_id
+
 
 # tries to find infrafred project setup in cache and, otherwise returns None
-def find_infrared_projects_in_cache(cityPyo_user):
-    try:
-        group_task_projects_creation = tasks.get_project_setup_from_cache.delay(cityPyo_user)
-    except:
+# wait=False does not wait for a setup that is still running, but returns None
+def find_infrared_projects_in_cache(cityPyo_user, wait=True):
+    group_task_id = find_cached_project_setup(cityPyo_user)
+
+    if group_task_id is None:
         print("Infrafred Project setup for cityPyo User not in cache")
         return None
 
     try:
-        infrared_projects = get_infrared_projects_from_group_task(group_task_projects_creation)
-    except:
-        print("Obtaining results from cache caused error.")
+        infrared_projects = get_infrared_projects_from_group(group_task_id, wait=wait)
+    except Exception as e:
+        print("Obtaining results from cache caused error.", e)
+        return None
+
+    if infrared_projects is None:
+        print("Infrafred Project setup for cityPyo User still running")
         return None
 
     print("Infrared projects found in cache", [ip["project_uuid"] for ip in infrared_projects])
@@ -153,10 +174,45 @@ def check_projects_for_user():
     if check_successful:
         return "success"
 
-# starts a wind or sun calculation
-def start_calculation(sim_type:str, city_pyo_user_id: str, calc_settings:dict, buildings_hash:str):
+
+# job-style variant of /check_projects_for_user. Returns the id of the check job right away.
+@app.route("/check_projects_for_user/async", methods=["POST"])
+def check_projects_for_user_async():
+    if not request.json:
+        print("no request json.")
+        abort(400, "No request.json")
+
+    try:
+        cityPyo_user = request.json["city_pyo_user"]
+    except KeyError as missing_arg:
+        abort(400, "Bad Request. Missing argument: %s" % missing_arg)
+
+    print("checking project status at AIT for user (async)", cityPyo_user)
+    check_task = tasks.check_projects_for_cityPyo_user.delay(cityPyo_user)
+
+    return make_response(
+        jsonify({'taskId': check_task.id}),
+        HTTPStatus.ACCEPTED,
+    )
+
+
+# starts a wind or sun calculation. Returns the id of the group task that will hold the results.
+# the group id is generated here, so the trigger does not wait for a worker to run compute_task.
+def start_calculation(sim_type:str, city_pyo_user_id: str, calc_settings:dict, buildings_hash:str) -> str:
  # check if Infrared-projects are cached and still exist. Otherwise recreate them at endpoint.
-    infrared_projects = find_infrared_projects_in_cache(city_pyo_user_id)
+    setup_group_id = find_cached_project_setup(city_pyo_user_id)
+    setup = GroupSnapshot.restore(setup_group_id, with_results=False) if setup_group_id else None
+
+    if setup is not None and not setup.processed():
+        # do not wait for the setup, nor start another one
+        abort(HTTPStatus.GATEWAY_TIMEOUT, (
+            f"Setup in process. This may take several minutes. \n"
+            f"Check with GET .../collect_results/{ setup_group_id }/status if setup is ready. \n"
+            f"Then repost your calculation request."
+            )
+        )
+
+    infrared_projects = find_infrared_projects_in_cache(city_pyo_user_id, wait=False)
     print("found infrared projects in cache", infrared_projects)
     if not check_infrared_projects_still_exist_at_infrared(infrared_projects):
         """
@@ -176,15 +232,23 @@ def start_calculation(sim_type:str, city_pyo_user_id: str, calc_settings:dict, b
             )    
         )
   
+    # announce the group before dispatching, so clients can ask for it right away.
+    # cache it right away, so identical requests arriving before compute_task ran do not start another calculation.
+    # (see find_calc_task_in_cache, a failed dispatch is no cache hit)
+    group_id = uuid()
+    announce_group_dispatch(group_id, "PENDING")
+    cache.save(key=get_cache_key_compute_task(sim_type, buildings_hash, hash_dict(calc_settings)), value=group_id)
+
     # compute result
-    calc_task = tasks.compute_task.delay(
+    tasks.compute_task.delay(
         sim_type=sim_type,
         infrared_projects=infrared_projects,
         calc_settings=calc_settings,
-        buildings_hash=buildings_hash
+        buildings_hash=buildings_hash,
+        group_id=group_id
     )
 
-    return calc_task
+    return group_id
 
 
 # sun
@@ -224,7 +288,7 @@ def trigger_calculation_sun():
         calc_settings = request.json.copy()
         del calc_settings["city_pyo_user"]
         
-        calc_task = start_calculation(
+        group_task_id = start_calculation(
             sim_type="sun",
             city_pyo_user_id=city_pyo_user_id,
             calc_settings=calc_settings,
@@ -232,10 +296,13 @@ def trigger_calculation_sun():
         )
         
         return make_response(
-            jsonify({'taskId': calc_task.get()}),
+            jsonify({'taskId': group_task_id}),
             HTTPStatus.OK,
         )
 
+    except werkzeug.exceptions.HTTPException:
+        raise
+
     except Exception as e:
         abort(500, e)
 
@@ -276,7 +343,7 @@ def trigger_calculation_wind():
     # if not in cache, start the calculation
     try:
         print("starting wind calculation")
-        calc_task = start_calculation(
+        group_task_id = start_calculation(
             sim_type="wind",
             city_pyo_user_id=city_pyo_user_id,
             calc_settings=calc_settings,
@@ -284,14 +351,163 @@ def trigger_calculation_wind():
         )
 
         return make_response(
-            jsonify({'taskId': calc_task.get()}),
+            jsonify({'taskId': group_task_id}),
             HTTPStatus.OK,
         )
 
+    except werkzeug.exceptions.HTTPException:
+        raise
+
     except Exception as e:
         abort(500, e)
 
 
+# merges the results of the finished tasks of a group into 1 GeoDataFrame in crs. Returns None if there are no results yet.
+# every finished tile is folded into the merge state of the group once, instead of re-merging all tiles per request.
+def merge_results_of_group_as_gdf(grouptask_id: str, ready_results: list, crs="EPSG:4326"):
+    merge_state = update_merge_state(grouptask_id, ready_results)
+
+    if merge_state is None:
+        # results from before the global result grid can not be merged incrementally
+        tile_results = [result.get() for result in ready_results if result.state == "SUCCESS"]
+        if not tile_results:
+            return None
+        geojson = summarize_tile_results(tile_results)
+        if not geojson["features"]:
+            return None
+        return geopandas.GeoDataFrame.from_features(geojson["features"], crs="EPSG:4326").to_crs(crs)
+
+    if not merge_state["grid"]:
+        return None
+
+    # polygons of the global grid are in EPSG:25832
+    gdf = get_result_polygons(*import_global_grid_block(merge_state["grid"]))
+    if gdf.empty:
+        return None
+
+    return gdf.to_crs(crs)
+
+
+# merges the results of the finished tasks of a group into 1 geojson. Returns [] if there are no results yet.
+def merge_results_of_group(grouptask_id: str, ready_results: list):
+    gdf = merge_results_of_group_as_gdf(grouptask_id, ready_results)
+    if gdf is None:
+        return []
+
+    return json.loads(gdf.to_json(na='null', show_bbox=False))
+
+
+# folds the tiles finished since the last call into the merge state of the group.
+# returns the merge state {"included": [task ids], "grid": global grid block or None}
+# or None, if results from before the global result grid are part of the group.
+def update_merge_state(grouptask_id: str, ready_results: list):
+    successful_results = [result for result in ready_results if result.state == "SUCCESS"]
+
+    merge_state_key = get_cache_key_merge_state(grouptask_id)
+    merge_state = cache.retrieve(key=merge_state_key) or {"included": [], "grid": None}
+
+    new_results = [result for result in successful_results if result.id not in merge_state["included"]]
+    tile_results = [result.get() for result in new_results]
+
+    if not all("grid" in tile_result for tile_result in tile_results):
+        return None
+
+    if tile_results:
+        merge_state = {
+            "included": merge_state["included"] + [result.id for result in new_results],
+            "grid": fold_tile_results_into_mosaic(merge_state["grid"], tile_results),
+        }
+        cache.save(key=merge_state_key, value=merge_state, expiry=config.merged_result_partial_expiry)
+
+    return merge_state
+
+
+# reads the options for png results from the request args (see geojson_to_png.get_png_pixel_size)
+def get_png_options(request_args: dict) -> dict:
+    png_options = {}
+    option_types = {
+        "png_pixel_size": ("pixel_size", float),
+        "png_width": ("width", int),
+        "png_height": ("height", int),
+        "png_max_pixels": ("max_pixels", int),
+    }
+
+    for arg, (option, option_type) in option_types.items():
+        if arg not in request_args:
+            continue
+        try:
+            value = option_type(request_args[arg])
+        except ValueError:
+            abort(400, "Bad Request. Invalid value for %s" % arg)
+        if not math.isfinite(value) or value <= 0:
+            abort(400, "Bad Request. %s needs to be a positive number" % arg)
+        png_options[option] = value
+
+    if "png_palette" in request_args:
+        if request_args["png_palette"] not in palettes:
+            abort(400, "Bad Request. png_palette needs to be one of %s" % list(palettes.keys()))
+        png_options["palette"] = request_args["png_palette"]
+
+    if "image_format" in request_args:
+        if request_args["image_format"] not in image_formats:
+            abort(400, "Bad Request. image_format needs to be one of %s" % image_formats)
+        png_options["image_format"] = request_args["image_format"]
+
+    return png_options
+
+
+# yields the features of the ready tiles as newline delimited geojson, one tile after another.
+# Only one tile result is held in memory at a time, results are read from the backend while streaming
+# (see GroupSnapshot with_results=False). Features are tagged with the task id of their tile.
+def stream_results_of_group(ready_results: list):
+    for result in ready_results:
+        if result.state != "SUCCESS":
+            continue
+
+        tile_result = result.get()
+        if "grid" in tile_result:
+            # tiles of the global grid do not overlap
+            features = convert_raster_to_geojson(*import_global_grid_block(tile_result["grid"]))["features"]
+        else:
+            # results from before the global result grid are streamed as they are
+            features = tile_result["geojson"]["features"]
+
+        for feature in features:
+            feature["properties"]["taskId"] = result.id
+            yield json.dumps(feature) + "\n"
+
+
+# returns a png result (the image) or a result in one of the columnar_formats as binary response.
+# Meta information is sent as headers.
+def make_binary_response(response: dict, result_format: str):
+    headers = {
+        "X-Grouptask-Id": response["grouptaskId"],
+        "X-Tasks-Completed": str(response["tasksCompleted"]),
+        "X-Tasks-Total": str(response["tasksTotal"]),
+        "X-Grouptask-Processed": str(response["grouptaskProcessed"]).lower(),
+    }
+
+    if not response["results"]:
+        # no results yet
+        return make_response("", HTTPStatus.NO_CONTENT, headers)
+
+    if result_format in columnar_formats:
+        headers["Content-Type"] = columnar_formats[result_format]
+        return make_response(base64.b64decode(response["results"]), HTTPStatus.OK, headers)
+
+    image = response["results"]
+    headers.update({
+        "X-Bbox-Coordinates": json.dumps(image["bbox_coordinates"]),
+        "X-Bbox-Sw-Corner": json.dumps(image["bbox_sw_corner"]),
+        "X-Img-Width": str(image["img_width"]),
+        "X-Img-Height": str(image["img_height"]),
+        "X-Pixel-Size": str(image["pixel_size"]),
+        "Content-Type": "image/" + image["image_format"],
+    })
+
+    return make_response(base64.b64decode(image["image_base64_string"]), HTTPStatus.OK, headers)
+
+
 # route to collect results
 @app.route("/collect_results/<grouptask_id>", methods=['GET'])
 @auth.login_required
@@ -303,25 +519,71 @@ def get_grouptask(grouptask_id: str):
     """
     request_args = request.args.to_dict()
     result_format = request_args.get("result_format")
-    print(f"Requested result of group task id {grouptask_id} , result_format {result_format}")
-
-    group_result = GroupResult.restore(grouptask_id, app=celery_app)
+    png_options = get_png_options(request_args) if result_format == "png" else {}
+    # binary=true returns png results as raw image instead of base64 in json. columnar formats are always binary.
+    binary = (result_format == "png" and request_args.get("binary") == "true") or result_format in columnar_formats
+    print(f"Requested result of group task id {grouptask_id} , result_format {result_format} {png_options}")
+
+    if result_format == "ndjson":
+        return get_grouptask_stream(grouptask_id)
+
+    def respond(response):
+        if binary:
+            return make_binary_response(response, result_format)
+        return make_response(response, HTTPStatus.OK)
+
+    # cached merged results are specific to format and png options
+    format_key = str(result_format) + ("_" + hash_dict(png_options) if png_options else "")
+
+    # the merged result of a processed group never changes
+    final_key = get_cache_key_merged_result(grouptask_id, format_key)
+    cached_response = cache.retrieve(key=final_key)
+    if cached_response:
+        return respond(cached_response)
+
+    # states only. update_merge_state reads the results of the tiles not merged yet, one by one
+    group_result = GroupSnapshot.restore(grouptask_id, with_results=False)
+    if group_result is None:
+        abort(404, "Not found. Unknown group task id %s" % grouptask_id)
+    if group_result.failed() and not group_result.dispatched():
+        abort(500, "Calculation of group task %s could not be started" % grouptask_id)
+    if not group_result.dispatched():
+        # the calculation is about to start. nothing to merge or cache yet.
+        return respond({
+            'grouptaskId': grouptask_id,
+            'tasksCompleted': 0,
+            'tasksTotal': 0,
+            'grouptaskProcessed': False,
+            'results': {"type": "FeatureCollection", "features": []} if result_format == "geojson" else []
+        })
     total_results_count = len(group_result.results)
-    results = [result.get() for result in group_result.results if result.ready()]
-    ready_results_count = len(results)
-    print(f"{len(results)} of { len(group_result.results) } tasks ready.")
-
-    
-    if results:
-        # first summarize the results into 1 geojson
-        results = summarize_multiple_geojsons_to_one([result["geojson"] for result in results])
-    
-        if result_format == "png":
+    ready_results = group_result.ready_results
+    ready_results_count = len(ready_results)
+    print(f"{ready_results_count} of { len(group_result.results) } tasks ready.")
+
+    # serve the merged result from cache, if no further tile finished since it was merged
+    partial_key = get_cache_key_merged_result(grouptask_id, format_key, [result.id for result in ready_results])
+    cached_response = cache.retrieve(key=partial_key)
+    if cached_response:
+        return respond(cached_response)
+
+    if result_format in columnar_formats:
+        # encoded straight from the GeoDataFrame, without geojson in between
+        gdf = merge_results_of_group_as_gdf(grouptask_id, ready_results)
+        results = convert_result_to_columnar(gdf, result_format) if gdf is not None else ""
+
+    elif result_format == "png":
+        # rasterized straight from the polygons in utm, without geojson and reprojection in between
+        gdf = merge_results_of_group_as_gdf(grouptask_id, ready_results, crs="EPSG:25832")
+        results = []
+        if gdf is not None:
             print("converting result to png")
-            results = convert_result_to_png(results)
+            results = convert_result_to_png(gdf, **png_options)
 
     else:
-        if result_format == "geojson":
+        results = merge_results_of_group(grouptask_id, ready_results)
+
+        if not results and result_format == "geojson":
             # return empty geojson if no results
             results = {
                 "type": "FeatureCollection",
@@ -334,16 +596,187 @@ def get_grouptask(grouptask_id: str):
         'grouptaskId': group_result.id,
         'tasksCompleted': group_result.completed_count(),
         'tasksTotal': total_results_count,
-        'grouptaskProcessed': total_results_count == ready_results_count,
+        'grouptaskProcessed': group_result.processed(),
         'results': results
     }
 
-    return make_response(
-        response,
-        HTTPStatus.OK,
-    )
+    if response['grouptaskProcessed']:
+        cache.save(key=final_key, value=response, expiry=config.merged_result_final_expiry)
+    else:
+        cache.save(key=partial_key, value=response, expiry=config.merged_result_partial_expiry)
+
+    return respond(response)
+
 
 
+# streams the results of a group task as newline delimited geojson features (see stream_results_of_group)
+def get_grouptask_stream(grouptask_id: str):
+    group_result = GroupSnapshot.restore(grouptask_id, with_results=False)
+    if group_result is None:
+        abort(404, "Not found. Unknown group task id %s" % grouptask_id)
+    total_results_count = len(group_result.results)
+    ready_results = group_result.ready_results
+    print(f"{len(ready_results)} of {total_results_count} tasks ready. Streaming results.")
+
+    headers = {
+        "X-Grouptask-Id": group_result.id,
+        "X-Tasks-Completed": str(group_result.completed_count()),
+        "X-Tasks-Total": str(total_results_count),
+        "X-Grouptask-Processed": str(group_result.processed()).lower(),
+    }
+
+    return Response(stream_results_of_group(ready_results), mimetype="application/x-ndjson", headers=headers)
+
+
+# route to get map tiles of results
+@app.route("/results/<grouptask_id>/tiles/<int:z>/<int:x>/<int:y>.<image_format>", methods=['GET'])
+@auth.login_required
+def get_result_tile(grouptask_id: str, z: int, x: int, y: int, image_format: str):
+    """
+    Route to get XYZ map tiles (web mercator) of the results of a group task.
+    Tiles are rendered from the merged result grid of all sub-tasks that are ready.
+    Image tiles (png, webp) have 256px, vector tiles (mvt) hold the result polygons in layer "results".
+    Returns 204 for tiles without results.
+    """
+    if image_format not in image_formats + ["mvt"]:
+        abort(404, "Not found. Tiles are available as %s" % (image_formats + ["mvt"]))
+    if not is_valid_tile(z, x, y):
+        abort(404, "Not found. Invalid tile %s/%s/%s" % (z, x, y))
+
+    palette = request.args.get("png_palette")
+    if palette is not None and palette not in palettes:
+        abort(400, "Bad Request. png_palette needs to be one of %s" % list(palettes.keys()))
+
+    tile = "_".join([str(z), str(x), str(y), image_format, str(palette)])
+
+    # tiles of a processed group never change
+    final_key = get_cache_key_result_tile(grouptask_id, tile)
+    cached_tile = tile_cache.get(final_key)
+
+    if cached_tile is None:
+        group_result = GroupSnapshot.restore(grouptask_id, with_results=False)
+        if group_result is None:
+            abort(404, "Not found. Unknown group task id %s" % grouptask_id)
+        ready_results = group_result.ready_results
+        grouptask_processed = group_result.processed()
+
+        # tiles of a group in progress are valid until a further sub-task finished
+        key = final_key if grouptask_processed else \
+            get_cache_key_result_tile(grouptask_id, tile, [result.id for result in ready_results])
+        cached_tile = tile_cache.get(key)
+
+        if cached_tile is None:
+            merge_state = update_merge_state(grouptask_id, ready_results)
+            if merge_state is None:
+                abort(404, "Not found. No map tiles available for the results of this group task")
+
+            rendered_tile = None
+            if merge_state["grid"] and image_format == "mvt":
+                polygon_index = get_result_polygon_index(
+                    grouptask_id + "_" + hash_dict(sorted(merge_state["included"])), merge_state["grid"]
+                )
+                rendered_tile = render_result_vector_tile(polygon_index, z, x, y)
+            elif merge_state["grid"]:
+                rendered_tile = render_result_tile(
+                    *import_global_grid_block(merge_state["grid"]), z, x, y, image_format, palette
+                )
+            cached_tile = rendered_tile or b""
+
+            expiry = config.merged_result_final_expiry if grouptask_processed else config.merged_result_partial_expiry
+            tile_cache.save(key, cached_tile, expiry=expiry)
+
+    if not cached_tile:
+        return make_response("", HTTPStatus.NO_CONTENT)
+
+    content_type = mvt_content_type if image_format == "mvt" else "image/" + image_format
+    return make_response(cached_tile, HTTPStatus.OK, {"Content-Type": content_type})
+
+
+# formats a server-sent event
+def format_sse(event: str, data: dict) -> str:
+    return "event: " + event + "\n" + "data: " + json.dumps(data) + "\n\n"
+
+
+# yields the progress of a group as server-sent events:
+# "progress" {tasksCompleted, tasksFailed, tasksTotal} first and after each finished tile, "tile" {taskId, state} per finished tile,
+# and "done" once all tiles are finished. The stream ends after config.sse_max_duration, clients reconnect.
+# tasksCompleted counts the successful tiles only, as in /collect_results/<grouptask_id>/status.
+# finished_tasks {task id: state} are the tiles finished before the stream started.
+# a group that is not dispatched yet ends the stream after the first progress event. Clients reconnect after 2s.
+def stream_group_progress(subscription, finished_tasks: dict, total_results_count: int, dispatched=True):
+    def progress():
+        failed_count = sum(state == "FAILURE" for state in finished_tasks.values())
+        return {
+            "tasksCompleted": len(finished_tasks) - failed_count,
+            "tasksFailed": failed_count,
+            "tasksTotal": total_results_count,
+        }
+
+    try:
+        yield "retry: 2000\n\n"
+        yield format_sse("progress", progress())
+
+        if not dispatched:
+            return
+
+        stream_end = time.time() + config.sse_max_duration
+        last_message = time.time()
+
+        while len(finished_tasks) < total_results_count and time.time() < stream_end:
+            message = subscription.get_message(timeout=1)
+
+            if message is None:
+                if time.time() - last_message > config.sse_keepalive_interval:
+                    last_message = time.time()
+                    # a comment keeps proxies from closing the idle connection
+                    yield ": keepalive\n\n"
+                continue
+
+            event = json.loads(message["data"])
+            if event["taskId"] in finished_tasks:
+                continue
+
+            finished_tasks[event["taskId"]] = event["state"]
+            last_message = time.time()
+            yield format_sse("tile", event)
+            yield format_sse("progress", progress())
+
+        if len(finished_tasks) >= total_results_count:
+            yield format_sse("done", progress())
+
+    finally:
+        subscription.close()
+
+
+# route to follow the progress of group tasks
+@app.route("/collect_results/<grouptask_id>/events", methods=['GET'])
+@auth.login_required
+def get_grouptask_events(grouptask_id: str):
+    """
+    Route to follow the progress of group tasks as server-sent events (text/event-stream).
+    Replaces polling of /collect_results/<grouptask_id>/status. Workers announce each finished tile.
+    """
+    print(f"Requested progress events of group task id {grouptask_id}")
+
+    # subscribe before taking the snapshot, so no tile finishing in between is missed
+    subscription = progress_channel.subscribe(grouptask_id)
+
+    group_result = GroupSnapshot.restore(grouptask_id, with_results=False)
+    if group_result is None:
+        subscription.close()
+        abort(404, "Not found. Unknown group task id %s" % grouptask_id)
+    if group_result.failed() and not group_result.dispatched():
+        subscription.close()
+        abort(500, "Calculation of group task %s could not be started" % grouptask_id)
+
+    finished_tasks = {result.id: result.state for result in group_result.ready_results}
+
+    return Response(
+        stream_group_progress(subscription, finished_tasks, len(group_result.results), group_result.dispatched()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 # route to collect results
 @app.route("/collect_results/<grouptask_id>/status", methods=['GET'])
@@ -354,7 +787,10 @@ def get_grouptask_status(grouptask_id: str):
     """
     print(f"Requested status of group task id {grouptask_id}")
 
-    group_result = GroupResult.restore(grouptask_id, app=celery_app)
+    # one round trip for the states of all tasks
+    group_result = GroupSnapshot.restore(grouptask_id, with_results=False)
+    if group_result is None:
+        abort(404, "Not found. Unknown group task id %s" % grouptask_id)
 
     status = "PENDING"
     if group_result.successful():
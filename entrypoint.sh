@@ -7,6 +7,8 @@ set -e
 
 gunicorn \
   --workers 8 \
+  --worker-class gthread \
+  --threads 16 \
   --bind 0.0.0.0:5000 \
   --log-level debug \
   --timeout 5000 \
@@ -0,0 +1,31 @@
+from io import BytesIO
+
+import geopandas
+import pyarrow
+import pyarrow.ipc
+
+
+# binary result formats -> content type
+columnar_formats = {
+    "geoparquet": "application/vnd.apache.parquet",
+    "flatgeobuf": "application/flatgeobuf",  # with spatial index, streamable
+    "arrow": "application/vnd.apache.arrow.file",  # Arrow IPC file, geometries as WKB
+}
+
+
+# encodes a GeoDataFrame in one of the columnar_formats
+def encode_gdf(gdf: geopandas.GeoDataFrame, result_format: str) -> bytes:
+    output_buffer = BytesIO()
+
+    if result_format == "geoparquet":
+        gdf.to_parquet(output_buffer, index=False)
+    elif result_format == "flatgeobuf":
+        gdf.to_file(output_buffer, driver="FlatGeobuf", engine="pyogrio", SPATIAL_INDEX="YES")
+    elif result_format == "arrow":
+        table = pyarrow.table(gdf.to_arrow(index=False, geometry_encoding="WKB"))
+        with pyarrow.ipc.new_file(output_buffer, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError("Unknown result format %s" % result_format)
+
+    return output_buffer.getvalue()
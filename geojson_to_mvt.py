@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+
+import mapbox_vector_tile
+import shapely
+from shapely.geometry import box
+
+from geojson_to_png import get_tile_bounds_mercator
+from wind.data import get_result_polygons, import_global_grid_block
+
+
+mvt_layer_name = "results"
+mvt_extent = 4096  # coordinates per tile side
+mvt_buffer = 64  # tile coordinates rendered beyond the tile border, so polygon outlines do not show at tile seams
+index_cache_size = 8  # result polygon indexes kept in memory
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+class ResultPolygonIndex:
+    """Polygons of a result in web mercator (EPSG:3857), with a spatial index to find the polygons of a tile
+        Multipolygons are split into their parts, so a tile only touches the parts it shows.
+    """
+    def __init__(self, np_values, transform):
+        gdf = get_result_polygons(np_values, transform)
+        gdf = gdf.to_crs("EPSG:3857").explode(index_parts=False).reset_index(drop=True)
+
+        self.geometries = gdf.geometry.values
+        self.values = gdf["value"].to_numpy()
+        self.sindex = gdf.sindex
+
+    def query(self, bounds):
+        indices = self.sindex.query(box(*bounds))
+
+        return self.geometries[indices], self.values[indices]
+
+
+# returns the polygon index of a merged result grid (see wind.data.export_global_grid_block).
+# state_key identifies the merge state, the index is built once per process.
+def get_result_polygon_index(state_key: str, grid: dict) -> ResultPolygonIndex:
+    with _index_cache_lock:
+        index = _index_cache.get(state_key)
+        if index is not None:
+            _index_cache.move_to_end(state_key)
+            return index
+
+    index = ResultPolygonIndex(*import_global_grid_block(grid))
+
+    with _index_cache_lock:
+        _index_cache[state_key] = index
+        while len(_index_cache) > index_cache_size:
+            _index_cache.popitem(last=False)
+
+    return index
+
+
+# renders a XYZ tile of the result polygons as Mapbox Vector Tile.
+# polygons are clipped to the (buffered) tile and simplified to the resolution of the zoom level.
+# returns the encoded tile, or None if the tile holds no results.
+def render_result_vector_tile(index: ResultPolygonIndex, z: int, x: int, y: int):
+    tile_bounds = get_tile_bounds_mercator(z, x, y)
+    unit = (tile_bounds[2] - tile_bounds[0]) / mvt_extent  # size of one tile coordinate in meters
+    clip_bounds = [
+        tile_bounds[0] - mvt_buffer * unit, tile_bounds[1] - mvt_buffer * unit,
+        tile_bounds[2] + mvt_buffer * unit, tile_bounds[3] + mvt_buffer * unit,
+    ]
+
+    geometries, values = index.query(clip_bounds)
+    if len(geometries) == 0:
+        return None
+
+    geometries = shapely.clip_by_rect(geometries, *clip_bounds)
+    # details below one tile coordinate are lost by the quantization anyway
+    geometries = shapely.simplify(geometries, unit, preserve_topology=True)
+
+    features = [
+        {"geometry": geometry, "properties": {"value": float(value)}}
+        for geometry, value in zip(geometries, values)
+        if not geometry.is_empty and geometry.area > 0
+    ]
+    if not features:
+        return None
+
+    return mapbox_vector_tile.encode(
+        [{"name": mvt_layer_name, "features": features}],
+        default_options={"quantize_bounds": tile_bounds, "extents": mvt_extent},
+    )
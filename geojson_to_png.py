@@ -10,37 +10,96 @@ import json
 
 import rasterio.features
 import rasterio.warp
+from rasterio.enums import Resampling
 import geopandas
 
 from shapely.geometry import Polygon, Point
 from pyproj import Transformer
 from shapely.ops import transform
+from rasterio.transform import Affine
+
+import config
+from wind.main import analysis_resolution
 
 transformer_to_wgs = Transformer.from_crs(25832, 4326, always_xy=True).transform
 
-def geojson_to_png(geojson, property_to_burn, resolution):
-    geom_value_pairs = [(feature["geometry"], feature["properties"][property_to_burn]) for feature in geojson["features"]]
-    png_value_for_nan = 255
-    image_data = rasterio.features.rasterize(shapes=geom_value_pairs, fill=png_value_for_nan, dtype='float64', out_shape=resolution)
+png_value_for_nan = 255
 
-    # set NaN as 255
-    image_data = [
-        [int(x*10) if not math.isnan(x) else png_value_for_nan for x in image_line]
-        for image_line in image_data
-    ]
 
-    # create a np array from image data
-    np_values = np.array(image_data, dtype="uint8")
-    print("unique values in image data ", np.unique(np_values))
+# rasterizes (geometry, value) pairs to an uint8 image array. Pixels hold value*10, pixels without value are 255.
+# resolution is the shape of the image (rows, cols), image_transform maps pixels to coordinates (default 1 pixel per unit)
+def rasterize_to_uint8(geom_value_pairs, resolution, image_transform=Affine.identity()) -> np.ndarray:
+    image_data = rasterio.features.rasterize(
+        shapes=geom_value_pairs, fill=np.nan, dtype='float64', out_shape=resolution, transform=image_transform
+    )
+
+    return values_to_uint8(image_data)
+
+
+# converts an array of result values to an uint8 image array. value*10, NaN as 255
+def values_to_uint8(values) -> np.ndarray:
+    no_data = np.isnan(values)
+    scaled = np.clip(np.rint(np.where(no_data, 0, values) * 10), 0, png_value_for_nan - 1)
+
+    return np.where(no_data, png_value_for_nan, scaled).astype("uint8")
+
+
+# colour tables for palette images. Pixel value (result value * 10) -> RGB. See the result tables in the README.
+palettes = {
+    # lawson criteria categories, "Sitting Long" to "Dangerous"
+    "lawson": {
+        0: (26, 152, 80),
+        2: (145, 207, 96),
+        4: (217, 239, 139),
+        6: (254, 224, 139),
+        8: (252, 141, 89),
+        10: (215, 48, 39),
+    },
+    # sunlight hours, "< 1.2 h/day" to "12 h/day"
+    "sun_hours": {
+        value: (
+            round(49 + (255 - 49) * value / 10),
+            round(54 + (237 - 54) * value / 10),
+            round(149 + (160 - 149) * value / 10),
+        )
+        for value in range(0, 11)
+    },
+}
+image_formats = ["png", "webp"]
+
+
+# creates a pillow image from an uint8 array and encodes it as png (or lossless webp).
+# with a palette the image is palette-indexed: pixel values stay value*10, the colours are embedded, no data is transparent.
+# transparent makes no data transparent in greyscale images as well.
+def encode_image(np_values, image_format="png", palette=None, transparent=False) -> bytes:
+    if palette:
+        im = Image.frombytes("P", (np_values.shape[1], np_values.shape[0]), np.ascontiguousarray(np_values).tobytes())
+        colour_table = [0] * 256 * 3
+        for value, rgb in palettes[palette].items():
+            colour_table[value * 3:value * 3 + 3] = rgb
+        im.putpalette(colour_table)
+        im.info["transparency"] = png_value_for_nan
+    else:
+        im = Image.fromarray(np_values)
+        if transparent:
+            im.info["transparency"] = png_value_for_nan
 
-    # create a pillow image, save it and convert to base64 string
-    im = Image.fromarray(np_values)
     output_buffer = BytesIO()
-    im.save(output_buffer, format='PNG')
-    byte_data = output_buffer.getvalue()
+    if image_format == "webp":
+        im.save(output_buffer, format='WEBP', lossless=True, quality=100, method=6)
+    else:
+        # the images consist of few large areas of the same value. maximum zlib compression pays off.
+        im.save(output_buffer, format='PNG', optimize=True, compress_level=9)
+
+    return output_buffer.getvalue()
+
+
+# create a pillow image from an uint8 array, save it as png and convert to base64 string
+def encode_png_as_base64(np_values, image_format="png", palette=None):
+    byte_data = encode_image(np_values, image_format, palette)
     base64_bytes = base64.b64encode(byte_data)
     base64_string = base64_bytes.decode('utf-8')
-    img_width, img_height = im.size
+    img_height, img_width = np_values.shape
 
     return base64_string, img_width, img_height
 
@@ -93,37 +152,142 @@ def get_bounds_coordinates_wgs(gdf_bounds):
     return list(bound_wgs.exterior.coords)
 
 
-def format_result_as_png(geojson=None):
+# returns the size of a pixel in meters, for an area of extent_x * extent_y meters.
+# by default the image matches the analysis grid. width/height request a target size (the image fits into both),
+# max_pixels limits width * height of the image.
+def get_png_pixel_size(extent_x, extent_y, pixel_size=None, width=None, height=None, max_pixels=None) -> float:
+    if width or height:
+        pixel_size = max(extent_x / width if width else 0, extent_y / height if height else 0)
+
+    if not pixel_size:
+        pixel_size = analysis_resolution
+
+    if max_pixels:
+        pixel_size = max(pixel_size, math.sqrt(extent_x * extent_y / max_pixels))
+
+    return pixel_size
+
+
+# returns the number of pixels (x, y) covering an area of extent_x * extent_y meters
+def get_png_resolution(extent_x, extent_y, pixel_size):
+    # (tolerance, so a requested width/height is not exceeded by float noise)
+    resolution_x = max(math.ceil(extent_x / pixel_size - 1e-6), 1)
+    resolution_y = max(math.ceil(extent_y / pixel_size - 1e-6), 1)
+
+    return resolution_x, resolution_y
+
+
+# returns pixel size and resolution (x, y) of an image of an area of extent_x * extent_y meters.
+# (see get_png_pixel_size). Rounding up to whole pixels may exceed max_pixels, the pixel size grows until it fits.
+# max_pixels is capped at config.png_max_pixels, whatever was requested.
+def get_png_dimensions(extent_x, extent_y, max_pixels=None, **resolution_options):
+    max_pixels = min(max_pixels or config.png_max_pixels, config.png_max_pixels)
+    pixel_size = get_png_pixel_size(extent_x, extent_y, max_pixels=max_pixels, **resolution_options)
+    resolution_x, resolution_y = get_png_resolution(extent_x, extent_y, pixel_size)
+
+    while max_pixels and resolution_x * resolution_y > max_pixels:
+        # the smallest pixel size saving a column or a row
+        pixel_size = min(
+            extent_x / (resolution_x - 1) if resolution_x > 1 else math.inf,
+            extent_y / (resolution_y - 1) if resolution_y > 1 else math.inf,
+        ) * (1 + 1e-6)
+        resolution_x, resolution_y = get_png_resolution(extent_x, extent_y, pixel_size)
+
+    return pixel_size, resolution_x, resolution_y
+
+
+# gdf: result polygons with a "value" column, in EPSG:25832
+# image_format: "png" or "webp", palette: None (greyscale) or a key of palettes
+# resolution_options: pixel_size, width, height, max_pixels (see get_png_dimensions)
+def format_result_as_png(gdf=None, image_format="png", palette=None, **resolution_options):
     cwd = os.path.dirname(os.path.abspath(__file__))
 
-    if not geojson:
+    if gdf is None:
         with open(cwd + "/results/result.geojson") as fp:
-            geojson = json.load(fp)
-
-    gdf = make_gdf_from_geojson(geojson, "EPSG:4326").to_crs("EPSG:25832")
+            gdf = make_gdf_from_geojson(json.load(fp), "EPSG:4326").to_crs("EPSG:25832")
 
     # get total bounds of original dataset (to position image on cityScope later)
-    gdf_total_bounds = gdf.total_bounds
-    
-    bounds_coordinates = get_bounds_coordinates_wgs(gdf_total_bounds)
-    south_west_corner_coords = get_south_west_corner_coords_gdf(gdf_total_bounds)
-    
-    #  Translate geometry to start at 0,0
-    gdf.geometry = gdf.translate(-gdf_total_bounds[0], -gdf_total_bounds[1])
+    left, bottom, right, top = gdf.total_bounds
 
     # calculate resolution of picture
-    gdf_total_bounds_translated = gdf.total_bounds
+    pixel_size, resolution_x, resolution_y = get_png_dimensions(right - left, top - bottom, **resolution_options)
 
-    resolution_x = math.ceil(gdf_total_bounds_translated[2] - gdf_total_bounds_translated[0])
-    resolution_y = math.ceil(gdf_total_bounds_translated[3] - gdf_total_bounds_translated[1])
+    # the image covers whole pixels, its bounds might reach a bit further than the data
+    image_bounds = [left, bottom, left + resolution_x * pixel_size, bottom + resolution_y * pixel_size]
+    bounds_coordinates = get_bounds_coordinates_wgs(image_bounds)
+    south_west_corner_coords = get_south_west_corner_coords_gdf(image_bounds)
 
-    # rasterize data
-    base64_string, img_width, img_height = geojson_to_png(json.loads(gdf.to_json()), "value", [resolution_x, resolution_y])
+    # rasterize data. rows start in the south, as the image is positioned by its south west corner
+    image_transform = Affine(pixel_size, 0, left, 0, pixel_size, bottom)
+    image_data = rasterize_to_uint8(zip(gdf.geometry, gdf["value"]), [resolution_y, resolution_x], image_transform)
+    base64_string, img_width, img_height = encode_png_as_base64(image_data, image_format, palette)
 
     return {
         "bbox_sw_corner": south_west_corner_coords,
         "img_width": img_width,
         "img_height": img_height,
+        "pixel_size": pixel_size,
+        "image_format": image_format,
         "bbox_coordinates": bounds_coordinates,
         "image_base64_string": base64_string
     }
+
+
+# XYZ map tiles (web mercator, EPSG:3857)
+tile_size = 256  # pixels
+max_tile_zoom = 22
+mercator_extent = 20037508.342789244  # meters from the origin to the border of the web mercator world
+
+
+# returns the bounds (left, bottom, right, top) of a XYZ tile in EPSG:3857
+def get_tile_bounds_mercator(z: int, x: int, y: int):
+    tile_extent = 2 * mercator_extent / 2 ** z
+    left = -mercator_extent + x * tile_extent
+    top = mercator_extent - y * tile_extent
+
+    return left, top - tile_extent, left + tile_extent, top
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= max_tile_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+# renders a XYZ tile from a block of the global result grid (EPSG:25832, see wind.data.import_global_grid_block).
+# returns the encoded image, or None if the tile holds no results.
+def render_result_tile(block, block_transform, z: int, x: int, y: int, image_format="png", palette=None):
+    tile_bounds = get_tile_bounds_mercator(z, x, y)
+
+    # skip tiles outside the results without warping
+    block_bounds = rasterio.warp.transform_bounds(
+        "EPSG:25832", "EPSG:3857",
+        block_transform.c, block_transform.f,
+        block_transform.c + block.shape[1] * block_transform.a, block_transform.f + block.shape[0] * block_transform.e,
+    )
+    if (block_bounds[0] >= tile_bounds[2] or block_bounds[2] <= tile_bounds[0]
+            or block_bounds[1] >= tile_bounds[3] or block_bounds[3] <= tile_bounds[1]):
+        return None
+
+    # the rows of the global grid count northwards. warp a north-up view of the block
+    north_up_block = np.ascontiguousarray(block[::-1])
+    north_up_transform = Affine(
+        block_transform.a, 0, block_transform.c,
+        0, -block_transform.e, block_transform.f + block.shape[0] * block_transform.e
+    )
+
+    tile_values = np.full((tile_size, tile_size), np.nan, dtype="float32")
+    rasterio.warp.reproject(
+        source=north_up_block,
+        destination=tile_values,
+        src_transform=north_up_transform,
+        src_crs="EPSG:25832",
+        src_nodata=np.nan,
+        dst_transform=rasterio.transform.from_bounds(*tile_bounds, tile_size, tile_size),
+        dst_crs="EPSG:3857",
+        dst_nodata=np.nan,
+        resampling=Resampling.nearest,
+    )
+
+    if np.isnan(tile_values).all():
+        return None
+
+    return encode_image(values_to_uint8(tile_values), image_format, palette, transparent=True)
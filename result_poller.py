@@ -0,0 +1,111 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from cache import ResultRegistry
+from tasks import collect_infrared_result
+from wind.main import poll_result_for_project
+
+# Description
+# Long-running service next to the celery workers (enable with RESULT_POLLER=true for workers and poller).
+# Polls all results outstanding at AIT concurrently, under one shared request budget.
+# Once a result arrives, its collect_infrared_result task is run again with the raw result for post-processing.
+
+tick = 1  # seconds between two scans of the registry
+initial_interval = 2  # seconds between the first polls of a result
+max_interval = 30  # seconds between polls of a result, after backing off
+
+
+class ResultPoller:
+    def __init__(self, request_budget=config.result_poller_request_budget, request_timeout=config.result_poller_request_timeout):
+        self.registry = ResultRegistry()
+        # the budget limits the number of requests to AIT in flight at any time.
+        # requests time out, so hung requests can not use up the budget
+        self.request_budget = asyncio.Semaphore(request_budget)
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(max_workers=request_budget)
+        # result_uuid -> [next poll time, current interval]
+        self.schedule = {}
+        # result_uuid -> the task polling it right now
+        self.in_flight = {}
+
+    async def run(self):
+        print("result poller started")
+        while True:
+            try:
+                await self.poll_outstanding_results()
+            except Exception as e:
+                print("result poller: polling failed", e)
+            await asyncio.sleep(tick)
+
+    async def poll_outstanding_results(self):
+        now = time.time()
+        entries = self.registry.get_all()
+
+        # forget results that are no longer outstanding
+        outstanding_uuids = {entry["result_uuid"] for entry in entries}
+        for result_uuid in list(self.schedule.keys()):
+            if result_uuid not in outstanding_uuids:
+                del self.schedule[result_uuid]
+
+        # each poll runs as task of its own. A slow poll does not hold back the next scan, nor the other polls.
+        for entry in entries:
+            result_uuid = entry["result_uuid"]
+            if result_uuid in self.in_flight:
+                continue
+            next_poll, _interval = self.schedule.setdefault(result_uuid, [now, initial_interval])
+            if next_poll <= now:
+                poll = asyncio.create_task(self.poll_entry(entry))
+                self.in_flight[result_uuid] = poll
+                poll.add_done_callback(lambda _poll, result_uuid=result_uuid: self.in_flight.pop(result_uuid, None))
+
+    async def poll_entry(self, entry: dict):
+        result_uuid = entry["result_uuid"]
+
+        async with self.request_budget:
+            try:
+                raw_result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, poll_result_for_project, result_uuid, entry["infrared_project_json"], self.request_timeout
+                )
+            except Exception as e:
+                print(f"result poller: could not poll result {result_uuid}", e)
+                raw_result = None
+
+        if raw_result is not None:
+            if self.registry.claim(result_uuid):
+                print(f"result poller: result {result_uuid} arrived")
+                self.hand_over(entry, raw_result)
+            return
+
+        if time.time() > entry["deadline"]:
+            if self.registry.claim(result_uuid):
+                print(f"result poller: giving up on result {result_uuid}")
+                # runs the task without raw result and an expired deadline, so the task fails
+                collect_infrared_result.apply_async(
+                    args=[result_uuid, entry["infrared_project_json"]],
+                    kwargs={"deadline": 0},
+                    task_id=entry["task_id"],
+                    group_id=entry.get("group_id"),
+                )
+            return
+
+        # back off
+        schedule = self.schedule.setdefault(result_uuid, [0, initial_interval])
+        schedule[0] = time.time() + schedule[1]
+        schedule[1] = min(schedule[1] * 2, max_interval)
+
+    # runs the post-processing of the result under the task id the group is waiting for.
+    # the group id lets the task announce its completion to the group (see tasks.task_postrun_handler)
+    @staticmethod
+    def hand_over(entry: dict, raw_result: dict):
+        collect_infrared_result.apply_async(
+            args=[entry["result_uuid"], entry["infrared_project_json"]],
+            kwargs={"deadline": entry["deadline"], "raw_result": raw_result},
+            task_id=entry["task_id"],
+            group_id=entry.get("group_id"),
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(ResultPoller().run())
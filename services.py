@@ -1,38 +1,176 @@
 import json
+import base64
 import hashlib
 import re
 import time
 
-from celery.result import GroupResult
+from celery import states
+from celery.result import result_from_tuple
 from celery_app import app as celery_app
 from geojson_to_png import format_result_as_png
+from gdf_to_columnar import encode_gdf
+from cache import Cache
+import config
 
 
 import wind.cityPyo as cp
 from wind.infrared_user import InfraredUser
 
 cityPyo = cp.CityPyo() ## put cityPyo container here
+cache = Cache()
+
+
+# gets a result GeoDataFrame (EPSG:25832) and returns it as png
+# png_options: pixel_size, width, height, max_pixels (see geojson_to_png.get_png_pixel_size)
+def convert_result_to_png(gdf, **png_options):
+    return format_result_as_png(gdf, **png_options)
+
+
+# gets a GeoDataFrame and returns it encoded in a binary columnar format (see gdf_to_columnar), as base64 string
+def convert_result_to_columnar(gdf, result_format):
+    return base64.b64encode(encode_gdf(gdf, result_format)).decode("utf-8")
+
+
+class TaskSnapshot:
+    """State and result of a task of a GroupSnapshot. Offers the parts of AsyncResult used by the api."""
+    def __init__(self, task_id: str, meta: dict, with_result=True):
+        self.id = task_id
+        self.state = meta["status"]
+        self._result = meta["result"]
+        # without result, get() reads the result from the backend when it is needed
+        self._has_result = with_result
 
+    def ready(self) -> bool:
+        return self.state in states.READY_STATES
 
-# gets a geojson and returns a result as png
-def convert_result_to_png(geojson):
-    return format_result_as_png(geojson)
+    def successful(self) -> bool:
+        return self.state == states.SUCCESS
+
+    def failed(self) -> bool:
+        return self.state == states.FAILURE
+
+    # returns the result, raises the exception of a failed task
+    def get(self):
+        result = self._result
+        if not self._has_result:
+            backend = celery_app.backend
+            meta = backend.get(backend.get_key_for_task(self.id))
+            result = backend.decode_result(meta)["result"] if meta else None
+
+        if self.failed():
+            raise result
+        return result
+
+
+class GroupSnapshot:
+    """Snapshot of the tasks of a group task.
+        Reads the metas of all tasks from the result backend in one MGET,
+        instead of round trips per task for each of ready(), successful(), completed_count(), get() ...
+        With with_results=False only the states are kept, results are read per task on get().
+        For routes that read the results of few tasks (e.g. the ones not merged yet), or one at a time.
+    """
+    def __init__(self, grouptask_id: str, task_ids: list, dispatch_state=states.SUCCESS, with_results=True):
+        self.id = grouptask_id
+        # SUCCESS once the group is saved. PENDING while compute_task builds it, FAILURE if that failed.
+        self.dispatch_state = dispatch_state
+
+        backend = celery_app.backend
+        metas = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids]) if task_ids else []
+
+        self.results = []
+        for task_id, meta in zip(task_ids, metas):
+            meta = backend.decode_result(meta) if meta else {"status": states.PENDING, "result": None}
+            if not with_results:
+                meta["result"] = None
+            self.results.append(TaskSnapshot(task_id, meta, with_results))
+
+    # returns the snapshot of a group task, None if the group is unknown.
+    # reads the saved group directly. GroupResult.restore would subscribe to the result channel of every task.
+    # groups announced by the api (see announce_group_dispatch) but not yet saved have no tasks.
+    @classmethod
+    def restore(cls, grouptask_id: str, with_results=True):
+        backend = celery_app.backend
+        meta = backend.get(backend.get_key_for_group(grouptask_id))
+        if meta is None:
+            dispatch = cache.retrieve(key=get_cache_key_group_dispatch(grouptask_id))
+            if dispatch:
+                return cls(grouptask_id, [], dispatch["status"], with_results)
+            return None
+
+        # saved as GroupResult.as_tuple(): ((group id, parent), [result tuples])
+        _group, result_tuples = backend.decode(meta)["result"]
+        task_ids = [result_from_tuple(result_tuple, celery_app).id for result_tuple in result_tuples]
+
+        return cls(grouptask_id, task_ids, with_results=with_results)
+
+    @property
+    def ready_results(self) -> list:
+        return [result for result in self.results if result.ready()]
+
+    # the tasks of the group are known
+    def dispatched(self) -> bool:
+        return self.dispatch_state == states.SUCCESS
+
+    # same as GroupResult.completed_count, the number of successful tasks
+    def completed_count(self) -> int:
+        return sum(result.successful() for result in self.results)
+
+    def successful(self) -> bool:
+        return self.dispatched() and all(result.successful() for result in self.results)
+
+    def failed(self) -> bool:
+        return self.dispatch_state == states.FAILURE or any(result.failed() for result in self.results)
+
+    # all tasks are ready
+    def processed(self) -> bool:
+        return self.dispatched() and all(result.ready() for result in self.results)
+
+
+# saves the state of a group task before its group is saved, so its id can be handed out before compute_task ran.
+# status: PENDING when dispatching compute_task, FAILURE if compute_task failed.
+def announce_group_dispatch(grouptask_id: str, status: str):
+    cache.save(key=get_cache_key_group_dispatch(grouptask_id), value={"status": status}, expiry=config.group_dispatch_expiry)
 
 
 def get_infrared_projects_from_group_task(group_task) -> list:
-    result = group_task.get()
-    group_result = GroupResult.restore(result, app=celery_app)
-    
+    return get_infrared_projects_from_group(group_task.get())
+
+
+# returns the infrared projects created by the group task of a project setup.
+# waits for the setup to finish. With wait=False returns None if the setup is still running.
+def get_infrared_projects_from_group(grouptask_id: str, wait=True):
+    group_snapshot = GroupSnapshot.restore(grouptask_id)
+    if group_snapshot is None:
+        raise Exception("Could not find group task of project setup", grouptask_id)
+
+    if not wait and not group_snapshot.processed():
+        return None
+
     # once the endpoint is setup the infrared projects should be served from cache
-    while not group_result.ready():
+    while not group_snapshot.processed():
         print("waiting for infrared projects to be setup")
         time.sleep(2)
+        group_snapshot = GroupSnapshot.restore(grouptask_id, with_results=False)
     
-    infrared_projects = [result.get() for result in group_result.results]
+    infrared_projects = [result.get() for result in group_snapshot.results]
 
     return infrared_projects
 
 
+# returns the group task id of a cached calculation, None if it is not cached
+def find_cached_calculation(sim_type: str, buildings_hash: str, calc_settings_hash: str):
+    group_task_id = cache.retrieve(key=get_cache_key_compute_task(sim_type, buildings_hash, calc_settings_hash))
+
+    return group_task_id or None
+
+
+# returns the group task id of the cached infrared project setup of a cityPyo user, None if it is not cached
+def find_cached_project_setup(user_id: str):
+    group_task_id = cache.retrieve(key=get_cache_key_setup_task(city_pyo_user=user_id))
+
+    return group_task_id or None
+
+
 def check_infrared_projects_still_exist_at_infrared(infrared_projects) -> bool:
     if not infrared_projects:
         # make sure to check valid list
@@ -56,8 +194,9 @@ def check_infrared_projects_still_exist_at_infrared(infrared_projects) -> bool:
     return calc_input_hash, buildings_hash, calc_input.export_to_json()
 
 
+# always revalidates the buildings at CityPyO. The hash of the current buildings decides about cached results.
 def get_buildings_geojson_from_cityPyo(cityPyo_user_id):
-    return cityPyo.get_buildings_for_user(cityPyo_user_id)
+    return cityPyo.get_buildings_for_user(cityPyo_user_id, max_age=0)
 
 
 def hash_dict(dict_to_hash):
@@ -71,6 +210,28 @@ def get_cache_key_compute_task(sim_type:str, buildings_hash:str, calc_settings_h
 def get_cache_key_setup_task(**kwargs):
     return "infrared_projects" + "_" + kwargs["city_pyo_user"]
 
+# key of a merged result of a group task. completed_task_ids=None for the final result of a processed group.
+def get_cache_key_merged_result(grouptask_id:str, result_format:str, completed_task_ids=None):
+    completed = "final" if completed_task_ids is None else hash_dict(sorted(completed_task_ids))
+    return "merged_result" + "_" + grouptask_id + "_" + str(result_format) + "_" + completed
+
+# key of the incremental merge state of a group task (tiles merged so far)
+def get_cache_key_merge_state(grouptask_id:str):
+    return "merge_state" + "_" + grouptask_id
+
+# key of a map tile of a group task result. completed_task_ids=None for tiles of a processed group.
+def get_cache_key_result_tile(grouptask_id:str, tile:str, completed_task_ids=None):
+    completed = "final" if completed_task_ids is None else hash_dict(sorted(completed_task_ids))
+    return "result_tile" + "_" + grouptask_id + "_" + tile + "_" + completed
+
+# key of the dispatch state of a group task whose group is not saved yet
+def get_cache_key_group_dispatch(grouptask_id:str):
+    return "group_dispatch" + "_" + grouptask_id
+
+# key of the buildings hash that was last synced to an infrared project at AIT
+def get_cache_key_buildings_sync(project_uuid:str):
+    return "synced_buildings" + "_" + project_uuid
+
 
 
 """ 
@@ -1,58 +1,82 @@
+import time
+
 from celery import signals, group, chain
+from celery.exceptions import Ignore
+from celery.result import AsyncResult
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 from celery_app import app
-from cache import Cache
+from cache import Cache, ResultRegistry, GroupProgressChannel
+import config
 
-from services import get_cache_key_compute_task, get_cache_key_setup_task, hash_dict
+from services import get_cache_key_compute_task, get_cache_key_setup_task, get_cache_key_buildings_sync, hash_dict, \
+    announce_group_dispatch, find_cached_project_setup, check_infrared_projects_still_exist_at_infrared, GroupSnapshot
 
 from wind.infrared_user import InfraredUser
 from wind.main import \
     get_bboxes, \
     create_infrared_project_for_bbox_and_user, \
     start_calculation_for_project, \
-    collect_result_for_project
+    collect_result_for_project, \
+    poll_result_for_project, \
+    get_buildings_for_projects
+from wind.data import get_buildings_fingerprint
+from wind.transport import get_transport
 
 
 logger = get_task_logger(__name__)
 cache = Cache()
+result_registry = ResultRegistry()
+progress_channel = GroupProgressChannel()
 
+# results are polled by re-scheduling the collecting task with exponential backoff, instead of sleeping in a worker
+result_poll_initial_countdown = 2  # seconds
+result_poll_max_countdown = 30  # seconds
+result_poll_max_wait = 10 * 60  # seconds until giving up on a result
 
-@app.task()
-def get_result_from_cache(
-    sim_type: str,
-    buildings_hash: str,
-    calc_input_hash: str
-):
-    # Check cache. If cached, return result from cache.
-    key = get_cache_key_compute_task(sim_type, buildings_hash, calc_input_hash)
-    result = cache.retrieve(key=key)
-    if not result == {}:
-        return result
-    else: 
-        raise Exception("Could not find result in cache")
+# the project check job waits for a recreation of the projects by re-scheduling itself
+project_setup_poll_interval = 5  # seconds
+project_setup_max_wait = 30 * 60  # seconds until giving up on the setup
 
 
-@app.task()
-def get_project_setup_from_cache(user_id):
-    # Check cache. If cached, return result from cache.     
-    key = get_cache_key_setup_task(city_pyo_user=user_id)
-    print(key)
-    group_result_id = cache.retrieve(key=key)
-    
-    if not group_result_id == {}:
-        print("retrieving infrared projects from cache")
-        return group_result_id
-    else: 
-        print("could not find project setup in cache!!")
-        raise Exception("Could not find setup in cache")
+# returns {"grid": {...}, "infrared_project_json": {...}} , grid is the result as block of the global result grid
+# if the result is not calculated yet, the task re-enqueues itself with a countdown. It only occupies a worker while polling.
+# with the result poller enabled, the task registers the result instead. The poller re-runs it with the raw_result.
+@app.task(bind=True, max_retries=None)
+def collect_infrared_result(self, result_uuid: str, infrared_project_json: dict, deadline=None, raw_result=None) -> dict:
+    if not result_uuid:
+        raise Exception("Calculation was not triggered at AIT for project", infrared_project_json["name"])
 
+    if deadline is None:
+        deadline = time.time() + result_poll_max_wait
 
+    if raw_result is None and config.result_poller_enabled:
+        if time.time() > deadline:
+            raise Exception("Could not get analysis_output from AIT", result_uuid)
+
+        result_registry.register({
+            "result_uuid": result_uuid,
+            "snapshot_uuid": infrared_project_json["snapshot_uuid"],
+            "infrared_project_json": infrared_project_json,
+            "task_id": self.request.id,
+            "group_id": self.request.group,
+            "deadline": deadline,
+        })
+        # keep the task pending. The poller runs it again under the same task id once the result is there.
+        raise Ignore()
+
+    if raw_result is None:
+        raw_result = poll_result_for_project(result_uuid, infrared_project_json)
+
+    if raw_result is None:
+        if time.time() > deadline:
+            raise Exception("Could not get analysis_output from AIT", result_uuid)
+
+        countdown = min(result_poll_initial_countdown * 2 ** self.request.retries, result_poll_max_countdown)
+        raise self.retry(countdown=countdown, kwargs={"deadline": deadline})
 
-# returns {"raw_result": {...}, "infrared_project_json": {...}}
-@app.task()
-def collect_infrared_result(result_uuid: str, infrared_project_json: dict) -> dict:
     # collect the result from AIT endpoint and format it
-    return collect_result_for_project(result_uuid, infrared_project_json)
+    return collect_result_for_project(result_uuid, infrared_project_json, raw_result)
 
 
 """ 
@@ -91,33 +115,168 @@ def compute_task(
     sim_type: str,
     infrared_projects: list,
     calc_settings: dict,
-    buildings_hash: str # just for caching
+    buildings_hash: str, # just for caching
+    group_id: str = None # id for the group task, handed out by the api before dispatching this task
     ):
+    infrared_projects = sorted(infrared_projects, key=lambda d: d['building_count'], reverse=True) # sort projects by building count (relevant results first)
+
+    # load the buildings once and hand each project only its own buildings, with their fingerprint.
+    # projects last synced with the same buildings of the user do not need any.
+    buildings_per_project = [None] * len(infrared_projects)
+    fingerprint_per_project = [None] * len(infrared_projects)
+    projects_to_sync = [
+        index for index, project in enumerate(infrared_projects)
+        if get_buildings_sync(project["project_uuid"]).get("buildings_hash") != buildings_hash
+    ]
+    if projects_to_sync:
+        city_pyo_user = infrared_projects[0]["cityPyo_user"]
+        buildings_to_sync = get_buildings_for_projects(city_pyo_user, [infrared_projects[index] for index in projects_to_sync])
+        for index, buildings_in_bbox in zip(projects_to_sync, buildings_to_sync):
+            buildings_per_project[index] = buildings_in_bbox
+            fingerprint_per_project[index] = get_buildings_fingerprint(buildings_in_bbox)
+
     # trigger calculation and collect result for project in infrared_projects
     task_group = group(
         [
             # create task chain for each project. tasks in chain will be executed sequentially
             chain(
-                trigger_calculation.s(sim_type, calc_settings, project), # returns result_uuid
+                trigger_calculation.s(sim_type, calc_settings, project, buildings_hash, buildings_in_bbox, fingerprint), # returns result_uuid
                 collect_infrared_result.s(project) # collect_result will have result_uuid as first argument
                 )
-            for project in sorted(infrared_projects, key=lambda d: d['building_count'], reverse=True) # sort projects by building count (relevant results first)
+            for project, buildings_in_bbox, fingerprint in zip(infrared_projects, buildings_per_project, fingerprint_per_project)
         ]
     )
     
-    group_result = task_group()
+    group_result = task_group(task_id=group_id or uuid())
     group_result.save()
 
     return group_result.id
 
+# checks if the infrared projects of a cityPyo user still exist at AIT. Otherwise recreates them and checks again.
+# runs as job for /check_projects_for_user/async. Waiting for a setup re-enqueues the task, it does not block a worker.
+# setup_task_id / setup_group_id: the setup task started by this job, or the group of a setup that was already running
+@app.task(bind=True, max_retries=None)
+def check_projects_for_cityPyo_user(self, user_id: str, setup_task_id=None, setup_group_id=None, deadline=None) -> bool:
+    if setup_task_id is None and setup_group_id is None:
+        setup_group_id = find_cached_project_setup(user_id)
+        setup = GroupSnapshot.restore(setup_group_id) if setup_group_id else None
+
+        if setup is not None and not setup.failed():
+            if not setup.processed():
+                print("waiting for running setup of infrared projects for cityPyo user", user_id)
+                raise self.retry(
+                    countdown=project_setup_poll_interval,
+                    kwargs={"setup_group_id": setup_group_id, "deadline": time.time() + project_setup_max_wait}
+                )
+            if check_infrared_projects_still_exist_at_infrared([result.get() for result in setup.results]):
+                # projects still exist, nothing to do.
+                return True
+
+        print("projects missing for cityPyo user", user_id)
+        setup_task = setup_infrared_projects_for_cityPyo_user.delay(user_id)
+        raise self.retry(
+            countdown=project_setup_poll_interval,
+            kwargs={"setup_task_id": setup_task.id, "deadline": time.time() + project_setup_max_wait}
+        )
+
+    if time.time() > deadline:
+        raise Exception("Setup of infrared projects did not finish in time for cityPyo user", user_id)
+
+    if setup_group_id is None:
+        setup_task = AsyncResult(setup_task_id, app=app)
+        if setup_task.failed():
+            raise Exception("Setup of infrared projects failed for cityPyo user", user_id)
+        if not setup_task.successful():
+            raise self.retry(countdown=project_setup_poll_interval)
+        # the setup task returns the id of the group creating the projects
+        setup_group_id = setup_task.result
+
+    setup = GroupSnapshot.restore(setup_group_id)
+    if setup is None or setup.failed():
+        raise Exception("Setup of infrared projects failed for cityPyo user", user_id)
+
+    if not setup.processed():
+        raise self.retry(
+            countdown=project_setup_poll_interval,
+            kwargs={"setup_group_id": setup_group_id, "deadline": deadline}
+        )
+
+    return check_infrared_projects_still_exist_at_infrared([result.get() for result in setup.results])
+
+
+# returns the last building sync of a project {"buildings_hash", "fingerprint"}, empty if unknown
+def get_buildings_sync(project_uuid: str) -> dict:
+    synced = cache.retrieve(key=get_cache_key_buildings_sync(project_uuid))
+
+    # syncs saved before fingerprints were kept are plain buildings hashes
+    return synced if isinstance(synced, dict) else {}
+
+
 # trigger calculation for a infrared project
+# buildings are only synced to the endpoint if they changed since the last sync of this project:
+# either the buildings of the user are the same (buildings_hash), or the buildings of the project are (buildings_fingerprint)
+# buildings_in_bbox are the buildings of the project (prepared by compute_task). If None they get fetched from cityPyo.
 @app.task()
-def trigger_calculation(sim_type, calc_settings, project):
-    return start_calculation_for_project(sim_type, calc_settings, project)
+def trigger_calculation(sim_type, calc_settings, project, buildings_hash=None, buildings_in_bbox=None, buildings_fingerprint=None):
+    sync_key = get_cache_key_buildings_sync(project["project_uuid"])
+    synced = get_buildings_sync(project["project_uuid"])
+    buildings_unchanged = buildings_hash is not None and (
+        synced.get("buildings_hash") == buildings_hash
+        or (buildings_fingerprint is not None and synced.get("fingerprint") == buildings_fingerprint)
+    )
+
+    if buildings_unchanged:
+        print(f"buildings of project {project['name']} unchanged since last sync. skipping building sync.")
+    else:
+        # a sync failing halfway leaves the project with some of the old and some of the new buildings.
+        # forget the last sync before it starts, it is only recorded again once the sync succeeded.
+        cache.delete(sync_key)
+
+    result_uuid = start_calculation_for_project(
+        sim_type, calc_settings, project, update_buildings=not buildings_unchanged, buildings_in_bbox=buildings_in_bbox
+    )
+
+    if buildings_hash is not None:
+        if buildings_unchanged and buildings_fingerprint is None:
+            buildings_fingerprint = synced.get("fingerprint")
+        cache.save(
+            key=sync_key,
+            value={"buildings_hash": buildings_hash, "fingerprint": buildings_fingerprint},
+            expiry=config.buildings_sync_expiry
+        )
+
+    return result_uuid
+
+
+# transport stats when a task started, to log the requests to AIT per task
+transport_stats_at_start = {}
+
+
+@signals.task_prerun.connect()
+def task_prerun_handler(task_id, task, *args, **kwargs):
+    transport_stats_at_start[task_id] = get_transport().export_stats()
+
+
+# logs how many requests to AIT a task made, and how long they waited for their slot vs. were on the wire
+def log_transport_stats(task_id, task):
+    stats_at_start = transport_stats_at_start.pop(task_id, None)
+    if stats_at_start is None:
+        return
+
+    stats = get_transport().export_stats()
+    request_count = stats["requests"] - stats_at_start["requests"]
+    if request_count:
+        print(
+            f"task {task.name} {task_id}: {request_count} requests to infrared, "
+            f"waited {stats['wait_seconds'] - stats_at_start['wait_seconds']:.2f}s for a slot, "
+            f"{stats['wire_seconds'] - stats_at_start['wire_seconds']:.2f}s on the wire"
+        )
 
 
 @signals.task_postrun.connect()
 def task_postrun_handler(task_id, task, sender=None, *args, **kwargs):
+    log_transport_stats(task_id, task)
+
     state = kwargs.get('state')
     func_args = kwargs.get('args')
     func_kwargs = kwargs.get('kwargs') 
@@ -150,6 +309,10 @@ def task_postrun_handler(task_id, task, sender=None, *args, **kwargs):
 
     # also cache the "compute_task" task where the first 2 arguments are hashes
     elif "compute_task" in task.name:
+        # the api handed out the group id already. let clients know the group will not come.
+        if state == "FAILURE" and func_kwargs.get("group_id"):
+            announce_group_dispatch(func_kwargs["group_id"], "FAILURE")
+
         # Cache only succeeded tasks
         if state == "SUCCESS":
             try:
@@ -163,3 +326,17 @@ def task_postrun_handler(task_id, task, sender=None, *args, **kwargs):
             key = get_cache_key_compute_task(sim_type, buildings_hash, hash_dict(calc_settings))
             cache.save(key=key, value=result)
             print("cached result with key %s" % key)
+
+    # notify the clients following the progress of the group (see /collect_results/<grouptask_id>/events)
+    elif "collect_infrared_result" in task.name:
+        if state in ["SUCCESS", "FAILURE"] and task.request.group:
+            progress_channel.publish(task.request.group, {"taskId": task_id, "state": state})
+
+    # a failed trigger marks the collect_infrared_result of its chain as failed, without running it.
+    # announce the failure for the collecting task, its postrun never happens.
+    elif "trigger_calculation" in task.name:
+        if state == "FAILURE":
+            for chained_task in task.request.chain or []:
+                options = chained_task.get("options", {})
+                if "collect_infrared_result" in chained_task.get("task", "") and options.get("group_id"):
+                    progress_channel.publish(options["group_id"], {"taskId": options["task_id"], "state": state})
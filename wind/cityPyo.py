@@ -5,10 +5,13 @@ import warnings
 import requests
 import os
 import json
+import hashlib
 
 import geopandas as gpd
 from shapely import wkb
 
+from wind.layer_cache import get_layer_cache, layer_ttl
+
 
 cwd = os.getcwd()
 
@@ -18,17 +21,20 @@ class CityPyo:
         - Logs in all users listed in config and saves their user ids.
         - Gets data from cityPyo
         - Posts data to cityPyo
+        - Caches layers per user (see wind.layer_cache)
     """
     def __init__(self):
         self.url = os.getenv("CITY_PYO")
+        self.layer_cache = get_layer_cache()
 
 
-    def get_buildings_for_user(self, user_id):
+    # max_age: seconds a cached layer may be old before it is revalidated at CityPyO. 0 always revalidates.
+    def get_buildings_for_user(self, user_id, max_age=layer_ttl):
         try:
             # prioritize a buildings.json
-            buildings_json = self.get_layer_for_user(user_id, "buildings")
+            buildings_json = self.get_layer_for_user(user_id, "buildings", max_age=max_age)
         except:
-            buildings_json = self.get_layer_for_user(user_id, "upperfloor")
+            buildings_json = self.get_layer_for_user(user_id, "upperfloor", max_age=max_age)
         
         # DROP Z VALUES IN GEOMETRY IF EXISTS
         df = gpd.GeoDataFrame.from_features(buildings_json["features"])
@@ -41,14 +47,31 @@ class CityPyo:
         return json.loads(df.to_json())
 
 
-    def get_layer_for_user(self, user_id, layer_name, recursive_iteration=0):
+    # returns a layer from cache if younger than max_age seconds,
+    # otherwise (re)fetches it from CityPyO with a conditional request if the cached layer has an ETag / Last-Modified
+    def get_layer_for_user(self, user_id, layer_name, recursive_iteration=0, max_age=layer_ttl):
+        cached = self.layer_cache.get(user_id, layer_name)
+
+        if cached and time.time() - cached["fetched_at"] < max_age:
+            return cached["data"]
+
         data = {
             "userid": user_id,
             "layer": layer_name
         }
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
 
         try:
-            response = requests.get(self.url + "getLayer", json=data)
+            response = requests.get(self.url + "getLayer", json=data, headers=headers)
+
+            if response.status_code == 304 and cached:
+                # layer did not change since it was cached
+                self.layer_cache.touch(user_id, layer_name, cached)
+                return cached["data"]
 
             if not response.status_code == 200:
                 print("could not get from cityPyo")
@@ -66,9 +89,22 @@ class CityPyo:
             time.sleep(30 * recursive_iteration)
             recursive_iteration += 1
 
-            return self.get_layer_for_user(user_id, layer_name, recursive_iteration)
+            return self.get_layer_for_user(user_id, layer_name, recursive_iteration, max_age)
+
+        layer = response.json()
+        self.layer_cache.save(user_id, layer_name, {
+            "data": layer,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "version": hashlib.md5(response.content).hexdigest(),
+            "fetched_at": time.time(),
+        })
+
+        return layer
 
-        return response.json()
+    # drops cached layers of a user, e.g. if the user changed them. layer_names=None drops all layers of the user.
+    def invalidate_layers_for_user(self, user_id, layer_names=None):
+        self.layer_cache.invalidate(user_id, layer_names)
 
 
     # logs a the performance of a AIT-calculation request to CityPyo
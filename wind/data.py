@@ -1,13 +1,14 @@
 import json
 import os
 import math
+import hashlib
 from geopandas.geodataframe import GeoDataFrame
 import numpy as np
 from typing import List
-from shapely.geometry import box, Polygon, mapping, MultiPolygon
+import shapely
+from shapely.geometry import box, Polygon
 
 import rasterio.features
-import rasterio.warp
 from rasterio.transform import Affine
 
 import geopandas
@@ -28,8 +29,6 @@ cityPyo = CityPyo()
 # gets [x,y] of the south west corner of the bbox.
 # might only work for european quadrant of the world
 def get_south_west_corner_coords_of_bbox(bbox):
-    import matplotlib.pyplot as plt
-
     longs = bbox.exterior.xy[0][0:-1]  # ignore repeated last coord
     lats = bbox.exterior.xy[1][0:-1] # ignore repeated last coord
 
@@ -42,39 +41,127 @@ def get_south_west_corner_coords_of_bbox(bbox):
             return [x, y]
 
 
+# returns the bbox enlarged by the buffer on every side (as used for the calculation at the endpoint)
+def get_buffered_bbox(bbox: Polygon, bbox_buffer) -> Polygon:
+    return bbox.buffer(bbox_buffer, cap_style=3).exterior.envelope
+
+
 # return an array of dicts, each dict describing a building with simple cartesian coordinates (origin 0,0)
+# MultiPolygons are split into one building per polygon. Parts of the intersection that are no polygons (e.g. touching edges) are dropped.
 def get_buildings_for_bbox(bbox:Polygon, buildings_gdf: GeoDataFrame) -> list:
-    buildings_in_bbox = []
+    # prefilter buildings with the spatial index (STRtree). Only those get intersected.
+    candidate_indices = np.sort(buildings_gdf.sindex.query(bbox, predicate="intersects"))
+
+    return clip_buildings_to_bbox(bbox, buildings_gdf.iloc[candidate_indices])
+
+
+# assigns the buildings to all bboxes in one pass over the spatial index.
+# returns an array with the buildings (see get_buildings_for_bbox) for each bbox
+def partition_buildings_for_bboxes(bboxes: List[Polygon], buildings_gdf: GeoDataFrame) -> List[list]:
+    bbox_indices, building_indices = buildings_gdf.sindex.query(np.array(bboxes, dtype=object), predicate="intersects")
+
+    buildings_per_bbox = []
+    for bbox_index, bbox in enumerate(bboxes):
+        candidate_indices = np.sort(building_indices[bbox_indices == bbox_index])
+        buildings_per_bbox.append(clip_buildings_to_bbox(bbox, buildings_gdf.iloc[candidate_indices]))
+
+    return buildings_per_bbox
+
+
+# clips the candidate buildings to the bbox and translates them to local coordinates of the bbox
+def clip_buildings_to_bbox(bbox: Polygon, candidates: GeoDataFrame) -> list:
     sw_x, sw_y = get_south_west_corner_coords_of_bbox(bbox) # south west corner for bbox, as utm.
 
-    intersection_polygons = buildings_gdf.intersection(bbox)  # GeoSeries with all intersection polygons bbox<->building
-    intersection_polygons = intersection_polygons.translate(-sw_x, -sw_y)  # translate to local coordinates from a 0,0 origin
-
-    intersections = buildings_gdf.copy()  # copy buildings dataframe with all properties
-    intersections.geometry = intersection_polygons # replace geometry with the building intersections
-
-    # iterate over intersections and append to buildings in bbox
-    for index, row in intersections.iterrows():
-        if not intersections.loc[index, 'geometry'].is_empty:
-            # MultiPolygons, need to be split into normal polygons
-            if type(intersections.loc[index, 'geometry']) == MultiPolygon:
-                multi_geometry = json.loads(json.dumps(mapping(intersections.loc[index, 'geometry'])))
-                for poly in multi_geometry["coordinates"][0]:
-                    single_poly = Polygon(poly)
-                    buildings_in_bbox.append({
-                        "geometry": json.dumps(mapping(single_poly)),
-                        "height": intersections.loc[index, 'building_height'],
-                        "use": intersections.loc[index, 'land_use_detailed_type'],
-                    })
-            # normal polygons
-            else:
-                buildings_in_bbox.append({
-                    "geometry": json.dumps(mapping(intersections.loc[index, 'geometry'])),
-                    "height": intersections.loc[index, 'building_height'],
-                    "use": intersections.loc[index, 'land_use_detailed_type'],
-                })
-
-    return buildings_in_bbox
+    intersections = GeoDataFrame(
+        {
+            "height": candidates["building_height"].to_numpy(),
+            "use": candidates["land_use_detailed_type"].to_numpy(),
+        },
+        geometry=candidates.geometry.intersection(bbox).translate(-sw_x, -sw_y).to_numpy(),  # translate to local coordinates from a 0,0 origin
+        crs=candidates.crs
+    )
+
+    # MultiPolygons (and GeometryCollections), need to be split into normal polygons
+    intersections = intersections.explode(index_parts=False)
+    intersections = intersections[(intersections.geom_type == "Polygon") & ~intersections.is_empty]
+
+    geometries = shapely.to_geojson(intersections.geometry.to_numpy())
+
+    return [
+        {"geometry": geometry, "height": height, "use": use}
+        for geometry, height, use in zip(geometries, intersections["height"].tolist(), intersections["use"].tolist())
+    ]
+
+
+# precision of building fingerprints. Coordinates are local meters, so 2 decimals is cm precision.
+fingerprint_precision = 2
+
+
+# rounds all coordinates of a (nested) geojson coordinate array
+def _round_coordinates(coordinates, precision):
+    if isinstance(coordinates, (list, tuple)) and coordinates and isinstance(coordinates[0], (list, tuple)):
+        return [_round_coordinates(coords, precision) for coords in coordinates]
+
+    # round(-0.001, 2) is -0.0, which would not compare equal as string. adding 0.0 normalizes the sign.
+    return [round(float(coord), precision) + 0.0 for coord in coordinates]
+
+
+# returns a hashable fingerprint of a building dict {"geometry", "height", "use"}
+# geometry is normalized to a fixed precision, so float noise does not make identical buildings differ.
+def get_building_fingerprint(building: dict, precision=fingerprint_precision) -> str:
+    geometry = building["geometry"]
+    if isinstance(geometry, str):
+        geometry = json.loads(geometry)
+
+    try:
+        height = round(float(building["height"]), precision) + 0.0
+    except (TypeError, ValueError):
+        height = building["height"]
+
+    normalized = [
+        geometry["type"],
+        _round_coordinates(geometry["coordinates"], precision),
+        height,
+        str(building.get("use")),
+    ]
+
+    return hashlib.md5(json.dumps(normalized).encode()).hexdigest()
+
+
+# returns a fingerprint of all buildings of a project (see get_buildings_for_bbox), independent of their order
+def get_buildings_fingerprint(buildings: list) -> str:
+    fingerprints = sorted(get_building_fingerprint(building) for building in buildings)
+
+    return hashlib.md5(json.dumps(fingerprints).encode()).hexdigest()
+
+
+# compares the buildings that should exist with the buildings at the endpoint {uuid: building}.
+# returns (buildings_to_create, uuids_to_delete, uuids_unchanged) in linear time.
+def diff_buildings(target_buildings: list, buildings_at_endpoint: dict):
+    # index the endpoint buildings by fingerprint. identical buildings may exist several times.
+    endpoint_index = {}
+    for uuid, building in buildings_at_endpoint.items():
+        try:
+            fingerprint = get_building_fingerprint(building)
+        except (KeyError, TypeError, ValueError):
+            # malformed building at endpoint, can never match. delete it.
+            fingerprint = None
+        endpoint_index.setdefault(fingerprint, []).append(uuid)
+
+    buildings_to_create = []
+    uuids_unchanged = []
+    for building in target_buildings:
+        matching_uuids = endpoint_index.get(get_building_fingerprint(building))
+        if matching_uuids:
+            # building already exists and did not update
+            uuids_unchanged.append(matching_uuids.pop())
+        else:
+            buildings_to_create.append(building)
+
+    # anything left in the index has no corresponding building in the target buildings
+    uuids_to_delete = [uuid for uuids in endpoint_index.values() for uuid in uuids]
+
+    return buildings_to_create, uuids_to_delete, uuids_unchanged
 
 
 # returns the project area as gdf
@@ -171,8 +258,9 @@ def create_bbox_matrix(polygon, bbox_length) -> List[box]:
     return bbox_matrix
 
 
-# exports a result to geotif and returns the geotif path
-def export_result_to_geotif(values, bbox_utm, project_name) -> str:
+# returns the result values as array and the affine transform placing the array on the bbox (utm).
+# the raster stays in memory, so conversions of concurrent calculations can not interfere.
+def get_result_raster(values, bbox_utm):
     np_values = np.array(values, dtype="float32")
     # TODO round values with around doesnt work??
     np_values = np.around(np_values, 1)
@@ -187,39 +275,130 @@ def export_result_to_geotif(values, bbox_utm, project_name) -> str:
     # Affine transformation
     transform = Affine.translation(x[0] - res_x / 2, y[0] - res_y / 2) * Affine.scale(res_x, res_y)
 
-    # save tif to disk. It will be used for quickly clipping result to area of interest later.
-    if not os.path.exists(cwd + "/tmp_tiff/"):
-        os.makedirs(cwd + "/tmp_tiff/")
-
-    file_path = cwd + "/tmp_tiff/" + project_name + ".tif"
-    with rasterio.open(
-            file_path,
-            'w+',
-            driver='GTiff',
-            height=np_values.shape[0],
-            width=np_values.shape[1],
-            count=1,
-            nodata=None,
-            dtype=np_values.dtype,
-            crs='EPSG:25832',
-            transform=transform,
-    ) as dataset:
-        dataset.write(np_values, 1)
-        dataset.close()
-
-    return file_path
-
-
-# converts tif to geojson and returns feature array
-def convert_tif_to_geojson(tif_path) -> List[dict]:
+    return np_values, transform
+
+
+# Results of all tiles are kept on one global grid in utm: cell (row, col) covers
+# [col * resolution, (col + 1) * resolution) x [row * resolution, (row + 1) * resolution). Rows count northwards.
+# So tiles can be mosaicked by array placement, without any vector union.
+
+# returns the affine transform of a block of the global grid
+def get_global_grid_transform(resolution, col_offset, row_offset) -> Affine:
+    return Affine(resolution, 0, col_offset * resolution, 0, resolution, row_offset * resolution)
+
+
+# resamples a raster to the cells of the global grid whose centers lie within the bbox.
+# a cell gets the most frequent value of the raster cells centered in it (majority), so thin categories of a finer
+# raster survive. Cells without any raster cell centered in them (coarser raster) take the nearest value.
+# returns the block of the global grid as array, and its col and row offset.
+# Neighbouring bboxes get complementary cells, so no cell is lost or doubled.
+def resample_raster_to_global_grid(np_values, transform, bbox: Polygon, resolution):
+    min_x, min_y, max_x, max_y = bbox.bounds
+    # tolerance for cell centers exactly on the bbox border
+    tolerance = 1e-6
+
+    # first cell with center >= min, first cell with center >= max
+    col_offset, col_end = [math.ceil(coord / resolution - 0.5 - tolerance) for coord in (min_x, max_x)]
+    row_offset, row_end = [math.ceil(coord / resolution - 0.5 - tolerance) for coord in (min_y, max_y)]
+
+    col_centers = (np.arange(col_offset, col_end) + 0.5) * resolution
+    row_centers = (np.arange(row_offset, row_end) + 0.5) * resolution
+
+    # nearest: cells of the input raster containing the centers
+    cols = np.floor((col_centers - transform.c) / transform.a).astype(int)
+    rows = np.floor((row_centers - transform.f) / transform.e).astype(int)
+    valid_cols = (cols >= 0) & (cols < np_values.shape[1])
+    valid_rows = (rows >= 0) & (rows < np_values.shape[0])
+
+    block = np.full((len(row_centers), len(col_centers)), np.nan, dtype="float32")
+    block[np.ix_(valid_rows, valid_cols)] = np_values[np.ix_(rows[valid_rows], cols[valid_cols])]
+
+    # majority: cells of the global grid containing the centers of the input raster
+    source_cols = np.floor((transform.c + (np.arange(np_values.shape[1]) + 0.5) * transform.a) / resolution).astype(int) - col_offset
+    source_rows = np.floor((transform.f + (np.arange(np_values.shape[0]) + 0.5) * transform.e) / resolution).astype(int) - row_offset
+    source_rows, source_cols = np.meshgrid(source_rows, source_cols, indexing="ij")
+    inside = (
+        ~np.isnan(np_values)
+        & (source_cols >= 0) & (source_cols < block.shape[1])
+        & (source_rows >= 0) & (source_rows < block.shape[0])
+    )
+    if inside.any():
+        cells = source_rows[inside] * block.shape[1] + source_cols[inside]
+        # values have 1 decimal (see get_result_raster), count them as integers
+        codes = np.rint(np_values[inside] * 10).astype("int64")
+        (cells, codes), counts = np.unique(np.stack([cells, codes]), axis=1, return_counts=True)
+
+        # most frequent value of each cell first (the lower value on ties), then keep the first of each cell
+        order = np.lexsort((-counts, cells))
+        cells, codes = cells[order], codes[order]
+        first_of_cell = np.r_[True, cells[1:] != cells[:-1]]
+        block.flat[cells[first_of_cell]] = codes[first_of_cell] / 10
+
+    return block, col_offset, row_offset
+
+
+# a block of the global grid as json serializable dict. NaN values become None.
+def export_global_grid_block(block, col_offset, row_offset, resolution) -> dict:
+    values = np.round(block.astype("float64"), 1)
+
+    return {
+        "resolution": resolution,
+        "col_offset": int(col_offset),
+        "row_offset": int(row_offset),
+        "values": np.where(np.isnan(values), None, values).tolist(),
+    }
+
+
+# returns array and transform of a block of the global grid exported with export_global_grid_block
+def import_global_grid_block(grid: dict):
+    block = np.array(grid["values"], dtype="float32").reshape(len(grid["values"]), -1)
+    transform = get_global_grid_transform(grid["resolution"], grid["col_offset"], grid["row_offset"])
+
+    return block, transform
+
+
+# places blocks of the global grid (see export_global_grid_block) into one array.
+# returns the mosaic and its transform
+def mosaic_global_grid_blocks(grids: List[dict]):
+    resolution = grids[0]["resolution"]
+    if any(grid["resolution"] != resolution for grid in grids):
+        raise ValueError("Can only mosaic results of the same resolution")
+
+    blocks = [import_global_grid_block(grid)[0] for grid in grids]
+
+    col_offset = min(grid["col_offset"] for grid in grids)
+    row_offset = min(grid["row_offset"] for grid in grids)
+    col_end = max(grid["col_offset"] + block.shape[1] for grid, block in zip(grids, blocks))
+    row_end = max(grid["row_offset"] + block.shape[0] for grid, block in zip(grids, blocks))
+
+    mosaic = np.full((row_end - row_offset, col_end - col_offset), np.nan, dtype="float32")
+    for grid, block in zip(grids, blocks):
+        row = grid["row_offset"] - row_offset
+        col = grid["col_offset"] - col_offset
+        target = mosaic[row:row + block.shape[0], col:col + block.shape[1]]
+        # keep values already placed, fill only no-data cells
+        np.copyto(target, block, where=np.isnan(target) & ~np.isnan(block))
+
+    return mosaic, get_global_grid_transform(resolution, col_offset, row_offset)
+
+
+# sets all cells whose centers are outside of the geometries (e.g. the ROI) to NaN
+def mask_raster_to_geometries(np_values, transform, geometries):
+    if np_values.size == 0:
+        return np_values
+
+    outside = rasterio.features.geometry_mask(list(geometries), out_shape=np_values.shape, transform=transform)
+
+    return np.where(outside, np.nan, np_values).astype(np_values.dtype)
+
+
+# polygonizes a result raster (EPSG:25832). returns a GeoDataFrame with one (multi)polygon per result value.
+def get_result_polygons(np_values, transform) -> geopandas.GeoDataFrame:
     features = []
-    dataset = rasterio.open(tif_path)
-    # Read the dataset's valid data mask as a ndarray.
-    mask = dataset.read(1)
 
     # Extract feature shapes and values from the array.
     for geom, val in rasterio.features.shapes(
-            mask, transform=dataset.transform):
+            np_values, transform=transform):
 
         if math.isnan(val):
             # ignore no values
@@ -233,12 +412,20 @@ def convert_tif_to_geojson(tif_path) -> List[dict]:
         # append feature to geojson
         features.append(feature)
 
-    # Use Geopandas to reproject all features to EPSG:4326
     # geopandas also automatically merges all polygons with same values
     gdf = geopandas.GeoDataFrame.from_features(features, crs="urn:ogc:def:crs:EPSG::25832",
                                                columns=["geometry", "value"])
     
-    gdf = gdf.dissolve(by="value").reset_index()
+    return gdf.dissolve(by="value").reset_index()
+
+
+# converts a raster (array + affine transform, utm) to geojson and returns feature array
+def convert_raster_to_geojson(np_values, transform) -> List[dict]:
+    if np_values.size == 0:
+        return {"type": "FeatureCollection", "features": []}
+
+    # Use Geopandas to reproject all features to EPSG:4326
+    gdf = get_result_polygons(np_values, transform)
     gdf = gdf.to_crs("EPSG:4326")
 
     reprojected_features_geojson = json.loads(gdf.to_json(na='null', show_bbox=False))  # features in geojson format
@@ -264,6 +451,30 @@ def get_bbox_size(bbox):
     return max(x_cooords) - min(x_cooords)
 
 
+# folds tile results into a mosaic on the global grid. mosaic_grid is a block of the global grid or None.
+# returns the new mosaic as block of the global grid (see export_global_grid_block)
+def fold_tile_results_into_mosaic(mosaic_grid, tile_results: List[dict]) -> dict:
+    grids = [result["grid"] for result in tile_results]
+    if mosaic_grid:
+        grids.insert(0, mosaic_grid)
+
+    mosaic, transform = mosaic_global_grid_blocks(grids)
+    resolution = grids[0]["resolution"]
+
+    return export_global_grid_block(mosaic, round(transform.c / resolution), round(transform.f / resolution), resolution)
+
+
+# takes an array of tile results and merges them into one geojson
+# tiles on the global grid are mosaicked and polygonized once. Results from before the global grid only have a geojson.
+def summarize_tile_results(tile_results: List[dict]) -> dict:
+    if all("grid" in result for result in tile_results):
+        mosaic, transform = mosaic_global_grid_blocks([result["grid"] for result in tile_results])
+
+        return convert_raster_to_geojson(mosaic, transform)
+
+    return summarize_multiple_geojsons_to_one([result["geojson"] for result in tile_results])
+
+
 # takes and array of geojsons and merges them into one
 def summarize_multiple_geojsons_to_one(geojson_array):
     # combine array of geojson to 1 geojson
@@ -1,15 +1,14 @@
 import os
 import time
-import json
 
 from shapely.ops import transform
 from shapely.geometry import Polygon
-import geopandas
 
-from wind.data import convert_tif_to_geojson, export_result_to_geotif, get_buildings_for_bbox, get_project_area_as_gdf, get_south_west_corner_coords_of_bbox, \
-    make_gdf_from_geojson, transformer_to_wgs, get_bbox_size, get_value
+from wind.data import get_result_raster, resample_raster_to_global_grid, mask_raster_to_geometries, \
+    get_global_grid_transform, export_global_grid_block, get_buildings_for_bbox, get_project_area_as_gdf, get_south_west_corner_coords_of_bbox, \
+    make_gdf_from_geojson, transformer_to_wgs, get_bbox_size, get_value, diff_buildings, get_buffered_bbox
 import wind.queries
-from wind.queries import make_query
+from wind.queries import make_query, make_batched_mutation
 from wind.infrared_user import InfraredUser
 from wind.cityPyo import CityPyo
 
@@ -17,6 +16,20 @@ cwd = os.getcwd()
 cityPyo = CityPyo()
 config = None
 
+# asks the endpoint once for an analysis output. Returns the output, or None if it is not calculated yet.
+def get_analysis_output(user: InfraredUser, project_uuid, snapshot_uuid, result_uuid, timeout=None):
+    response = make_query(wind.queries.get_analysis_output_query(result_uuid, snapshot_uuid), user, timeout)
+
+    if not get_value(response, ["data", "getAnalysisOutput", "infraredSchema"]):
+        return None
+
+    return get_value(
+        response, ["data", "getAnalysisOutput", "infraredSchema", "clients", user.uuid,
+                   "projects", project_uuid, "snapshots", snapshot_uuid, "analysisOutputs",
+                   result_uuid]
+    )
+
+
 """Class to handle Infrared communication for a InfraredProject (one bbox to analyze)"""
 class InfraredProject:
     def __init__(
@@ -29,7 +42,8 @@ class InfraredProject:
             bbox_buffer,
             snapshot_uuid=None,
             project_uuid=None,
-            update_buildings_at_endpoint=True
+            update_buildings_at_endpoint=True,
+            buildings_in_bbox=None
     ):
 
         # set properties
@@ -44,7 +58,7 @@ class InfraredProject:
         self.bbox_wgs = transform(transformer_to_wgs, bbox_utm)
 
         self.bbox_buffer = bbox_buffer
-        self.buffered_bbox_utm = bbox_utm.buffer(bbox_buffer, cap_style=3).exterior.envelope
+        self.buffered_bbox_utm = get_buffered_bbox(bbox_utm, bbox_buffer)
         self.buffered_bbox_wgs = transform(transformer_to_wgs, self.buffered_bbox_utm)
 
         self.analysis_grid_resolution = resolution
@@ -70,7 +84,7 @@ class InfraredProject:
         
         # udpate the buildings at the endpoint
         if update_buildings_at_endpoint: 
-            self.update_buildings()
+            self.update_buildings(buildings_in_bbox)
 
     """ Project Creation """
     
@@ -197,8 +211,7 @@ class InfraredProject:
             return
 
         # delete all buildings
-        for building_uuid in buildings_uuids:
-            make_query(wind.queries.delete_building(self.snapshot_uuid, building_uuid), self.user)  # todo async
+        self.delete_buildings(list(buildings_uuids))
 
     # deletes all streets
     def delete_all_streets(self, snapshot_geometries):
@@ -229,60 +242,56 @@ class InfraredProject:
     """ Project Updates """
 
     # updates all buildings at endpoint to match buildings at cityPyo (for all buildings in bbox)
-    def update_buildings(self):
+    # buildings_in_bbox can be provided if already known (see get_buildings_for_bbox), otherwise they are fetched from cityPyo
+    def update_buildings(self, buildings_in_bbox=None):
         print(f"updating buildings for project {self.name}")
 
-        # get current building geojson from cityPyo
-        cityPyo_buildings = cityPyo.get_buildings_for_user(self.cityPyo_user)
-        buildings_gdf = make_gdf_from_geojson(cityPyo_buildings)
-        if buildings_gdf.crs != "EPSG:25832":
-            buildings_gdf = buildings_gdf.to_crs("EPSG:25832")
+        if buildings_in_bbox is None:
+            # get current building geojson from cityPyo
+            cityPyo_buildings = cityPyo.get_buildings_for_user(self.cityPyo_user)
+            buildings_gdf = make_gdf_from_geojson(cityPyo_buildings)
+            if buildings_gdf.crs != "EPSG:25832":
+                buildings_gdf = buildings_gdf.to_crs("EPSG:25832")
 
-        # get buildings in this bbox that should be mirrored to endpoint
-        buildings_in_bbox = get_buildings_for_bbox(self.buffered_bbox_utm, buildings_gdf)
+            # get buildings in this bbox that should be mirrored to endpoint
+            buildings_in_bbox = get_buildings_for_bbox(self.buffered_bbox_utm, buildings_gdf)
         self.building_count = len(buildings_in_bbox)
 
         # get the buildings currently saved for project at endpoint
         buildings_at_endpoint = self.get_all_buildings_at_endpoint()
 
-        # delete any outdated buildings first
-        buildings_to_delete = []
-        for uuid, building_at_endpoint in buildings_at_endpoint.items():
-            # delete if the building at endpoint has no corresponding building on the current buildings array at cityPyo
-            if building_at_endpoint not in buildings_in_bbox:
-                buildings_to_delete.append(uuid)
-        
-        # create buildings that are in cityPyo but not at endpoint
-        buildings_to_create = []
-        # add or update buildings in bbox if changed
-        for city_io_bld in buildings_in_bbox:
-            if city_io_bld in buildings_at_endpoint.values():
-                # building already exists and did not update
-                continue
+        # diff by building fingerprint. unchanged buildings stay at the endpoint.
+        buildings_to_create, buildings_to_delete, unchanged_buildings = diff_buildings(buildings_in_bbox, buildings_at_endpoint)
+        print(f"buildings to create {len(buildings_to_create)}, to delete {len(buildings_to_delete)}, unchanged {len(unchanged_buildings)}")
 
-            # create new building
-            buildings_to_create.append(city_io_bld)
+        # delete any outdated buildings first
+        self.delete_buildings(buildings_to_delete)
+        self.create_new_buildings(buildings_to_create)
 
-        for uuid in buildings_to_delete:
-            self.delete_building(uuid)
 
-        for new_building in buildings_to_create:
-            self.create_new_building(new_building)
+    # deletes buildings at endpoint in batched mutations
+    def delete_buildings(self, building_uuids):
+        fields = [wind.queries.delete_building_field(self.snapshot_uuid, uuid) for uuid in building_uuids]
+        results = make_batched_mutation(fields, self.user)
 
+        for building_uuid, result in zip(building_uuids, results):
+            if not result:
+                print(f"could not delete building {building_uuid}")
 
-    def delete_building(self, building_uuid):
-        make_query(wind.queries.delete_building(self.snapshot_uuid, building_uuid), self.user)
 
+    # creates buildings at endpoint in batched mutations. buildings that failed are retried.
+    def create_new_buildings(self, new_buildings, tries=0):
+        max_tries = 3
+        fields = [wind.queries.create_building_field(building, self.snapshot_uuid) for building in new_buildings]
+        results = make_batched_mutation(fields, self.user)
 
-    def create_new_building(self, new_building):
-        query = wind.queries.create_building_query(new_building, self.snapshot_uuid)
-        new_bld_response = make_query(query, self.user) 
-        uuid = get_value(new_bld_response, ["data", "createNewBuilding", "uuid"])
+        failed_buildings = [building for building, result in zip(new_buildings, results) if not (result and result.get("uuid"))]
 
-        if not uuid:
-            print(f"could not create building! {new_bld_response}", )
-            print(f"Query {query}")
-            self.create_new_building(new_building)
+        if failed_buildings:
+            print(f"could not create {len(failed_buildings)} of {len(new_buildings)} buildings!")
+            if tries >= max_tries:
+                raise Exception("Could not create buildings at AIT", failed_buildings)
+            self.create_new_buildings(failed_buildings, tries + 1)
 
 
     """ Project Result Handling"""
@@ -322,53 +331,20 @@ class InfraredProject:
             print(f"Exception: {exception}")
 
 
-    # waits for the result to be avaible. Then crops it to the area of interest.
-    def get_result(self, result_uuid) -> dict:
-        tries = 0
-        max_tries = 100
-        response = make_query(wind.queries.get_analysis_output_query(result_uuid, self.snapshot_uuid), self.user)
-
-        # wait for result to arrive
-        while (not get_value(response, ["data", "getAnalysisOutput", "infraredSchema"])) and tries <= max_tries:
-            tries += 1
-            response = make_query(wind.queries.get_analysis_output_query(result_uuid, self.snapshot_uuid), self.user)
-            time.sleep(2)  # give the API some time to calc something
-
-        if not tries > max_tries:
-            result = get_value(
-                response, ["data", "getAnalysisOutput", "infraredSchema", "clients", self.user.uuid,
-                           "projects", self.project_uuid, "snapshots", self.snapshot_uuid, "analysisOutputs",
-                           result_uuid]
-            )
-            return self.get_result_as_geojson(result)
-        else:
-            raise Exception("Could not get analysis_output from AIT", result_uuid)
-    
-    
     """ 
     **** Result conversion and cropping ****
     """
-    # private
-    def get_result_as_geojson(self, raw_result):
-        tmp_geotif_raw_result = self.convert_result_to_geotif(raw_result, self.buffered_bbox_utm)
-        geojson_raw_result = convert_tif_to_geojson(tmp_geotif_raw_result)
-        
-        return self.remove_buffer_from_result_then_clip_to_roi(geojson_raw_result)
+    # removes the bbox buffer and masks the result to the ROI in raster space.
+    # returns the result as block of the global grid (see export_global_grid_block), to be mosaicked with other tiles.
+    def get_result_as_grid(self, raw_result) -> dict:
+        np_values, transform = get_result_raster(raw_result["analysisOutputData"], self.buffered_bbox_utm)
+
+        # remove bbox buffer, by taking only cells of the unbuffered bbox
+        block, col_offset, row_offset = resample_raster_to_global_grid(
+            np_values, transform, self.bbox_utm, self.analysis_grid_resolution
+        )
+        block_transform = get_global_grid_transform(self.analysis_grid_resolution, col_offset, row_offset)
+        # mask to ROI
+        block = mask_raster_to_geometries(block, block_transform, self.gdf_result_roi.to_crs("EPSG:25832").geometry)
 
-    # private
-    def convert_result_to_geotif(self, result, bbox):
-        # save result as geotif so it can be easily cropped to roi
-        geo_tif_path = export_result_to_geotif(result["analysisOutputData"], bbox, self.name)
-        
-        return geo_tif_path
-
-    # private
-    def remove_buffer_from_result_then_clip_to_roi(self, input_geojson):
-        # create a gdf of the unbuffered bbox. To clip to this.
-        bbox_gdf = geopandas.GeoDataFrame([self.bbox_wgs], columns=["geometry"], crs='EPSG:4326')
-        # remove bbox buffer
-        clipped_gdf = geopandas.clip(make_gdf_from_geojson(input_geojson), bbox_gdf)
-        # clip to ROI
-        clipped_gdf = geopandas.clip(clipped_gdf, self.gdf_result_roi.to_crs('EPSG:4326'))
-
-        return json.loads(clipped_gdf.to_json())
+        return export_global_grid_block(block, col_offset, row_offset, self.analysis_grid_resolution)
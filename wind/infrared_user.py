@@ -1,8 +1,8 @@
-import requests
 import os
 
 import wind.queries
 from wind.queries import make_query
+from wind.transport import get_transport
 
 cwd = os.getcwd()
 config = None
@@ -24,7 +24,7 @@ class InfraredUser:
     # logs in infrared user
     def infrared_user_login(self):
         user_creds = {"username": os.getenv("INFRARED_USERNAME"), "password": os.getenv("INFRARED_PASSWORD")}
-        request = requests.post(os.getenv("INFRARED_URL"), json=user_creds)
+        request = get_transport().post(os.getenv("INFRARED_URL"), json=user_creds)
 
         if request.status_code == 200:
             # get the auth token from the returned cookie
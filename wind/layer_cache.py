@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import redis
+
+from cache import get_redis_client
+
+
+# seconds a cached layer is served without asking CityPyO. After that it is revalidated by a conditional request.
+layer_ttl = float(os.getenv("CITYPYO_LAYER_TTL", 300))
+# number of layers kept in memory of each process
+lru_size = int(os.getenv("CITYPYO_LAYER_CACHE_SIZE", 32))
+# seconds the shared tier keeps a layer (and its ETag) after its last use
+redis_expiry = int(os.getenv("CITYPYO_LAYER_REDIS_EXPIRY", 24 * 60 * 60))
+
+_layer_cache = None
+
+
+class LayerCache:
+    """Class to cache CityPyO layers per (user, layer)
+        - an in-process LRU tier holding the parsed layers
+        - a shared redis tier, so all workers and the api profit from a download
+        - a small version entry in redis keeps the in-process tiers of all processes coherent
+
+        An entry is a dict {"data", "etag", "last_modified", "version", "fetched_at"}
+    """
+    def __init__(self, max_size=lru_size):
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.redis_client = get_redis_client()
+
+    @staticmethod
+    def _key(user_id, layer_name):
+        return "citypyo_layer_" + user_id + "_" + layer_name
+
+    @staticmethod
+    def _version_key(user_id, layer_name):
+        return "citypyo_layer_version_" + user_id + "_" + layer_name
+
+    # returns the cached entry or None
+    def get(self, user_id, layer_name):
+        key = self._key(user_id, layer_name)
+
+        try:
+            meta = self.redis_client.get(self._version_key(user_id, layer_name))
+        except redis.exceptions.RedisError as e:
+            print("Layer cache: redis not available, using in-process tier only. " + str(e))
+            return self._get_from_lru(key)
+
+        if meta is None:
+            # unknown (or invalidated) in the shared tier
+            self._remove_from_lru(key)
+            return None
+        meta = json.loads(meta)
+
+        entry = self._get_from_lru(key)
+        if entry is None or entry["version"] != meta["version"]:
+            try:
+                entry = self.redis_client.get(key)
+            except redis.exceptions.RedisError:
+                return None
+            if entry is None:
+                return None
+            entry = json.loads(entry)
+
+        # another process might have revalidated the layer in the meantime
+        entry["fetched_at"] = meta["fetched_at"]
+        self._put_to_lru(key, entry)
+
+        return entry
+
+    def save(self, user_id, layer_name, entry: dict):
+        key = self._key(user_id, layer_name)
+        self._put_to_lru(key, entry)
+
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.set(key, json.dumps(entry), ex=redis_expiry)
+            pipe.set(self._version_key(user_id, layer_name), json.dumps(
+                {"version": entry["version"], "fetched_at": entry["fetched_at"]}
+            ), ex=redis_expiry)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print("Layer cache: could not save layer to redis. " + str(e))
+
+    # marks a cached entry as fresh again, after CityPyO confirmed it did not change
+    def touch(self, user_id, layer_name, entry: dict):
+        entry["fetched_at"] = time.time()
+        self._put_to_lru(self._key(user_id, layer_name), entry)
+
+        try:
+            self.redis_client.set(self._version_key(user_id, layer_name), json.dumps(
+                {"version": entry["version"], "fetched_at": entry["fetched_at"]}
+            ), ex=redis_expiry)
+            self.redis_client.expire(self._key(user_id, layer_name), redis_expiry)
+        except redis.exceptions.RedisError as e:
+            print("Layer cache: could not update layer in redis. " + str(e))
+
+    # removes a layer (or all known layers if layer_names is None) of a user from both tiers
+    def invalidate(self, user_id, layer_names=None):
+        if layer_names is None:
+            prefix = self._key(user_id, "")
+            with self._lock:
+                layer_names = [key[len(prefix):] for key in self._lru.keys() if key.startswith(prefix)]
+            try:
+                layer_names.extend(
+                    key.decode()[len(prefix):] for key in self.redis_client.scan_iter(match=prefix + "*")
+                )
+            except redis.exceptions.RedisError:
+                pass
+
+        for layer_name in set(layer_names):
+            self._remove_from_lru(self._key(user_id, layer_name))
+            try:
+                self.redis_client.delete(self._key(user_id, layer_name), self._version_key(user_id, layer_name))
+            except redis.exceptions.RedisError as e:
+                print("Layer cache: could not invalidate layer in redis. " + str(e))
+
+    def _get_from_lru(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+            return entry
+
+    def _put_to_lru(self, key, entry):
+        with self._lock:
+            self._lru[key] = entry
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def _remove_from_lru(self, key):
+        with self._lock:
+            self._lru.pop(key, None)
+
+
+# returns the layer cache shared by all CityPyo instances of this process
+def get_layer_cache() -> LayerCache:
+    global _layer_cache
+
+    if _layer_cache is None:
+        _layer_cache = LayerCache()
+
+    return _layer_cache
@@ -2,9 +2,10 @@ from attr.setters import convert
 from shapely.geometry import Polygon
 
 from wind.cityPyo import CityPyo
-from wind.data import convert_tif_to_geojson, init_bbox_matrix_for_project_area, get_buildings_for_bbox, init_bbox_matrix_for_project_area, make_gdf_from_geojson
+from wind.data import init_bbox_matrix_for_project_area, get_buildings_for_bbox, init_bbox_matrix_for_project_area, make_gdf_from_geojson, \
+    get_buffered_bbox, partition_buildings_for_bboxes
 from wind.infrared_user import InfraredUser
-from wind.infrared_project import InfraredProject
+from wind.infrared_project import InfraredProject, get_analysis_output
 
 
 # todo get resolution and bbox_buffer from config
@@ -46,7 +47,7 @@ def create_infrared_user_from_json(infrared_user_json):
     )
     
 
-def recreate_infrared_project_from_json(infrared_project_json, update_buildings=True):
+def recreate_infrared_project_from_json(infrared_project_json, update_buildings=True, buildings_in_bbox=None):
     # locally recreate InfraredUser, to handle communication with the Infrared endpoint
     infrared_user = create_infrared_user_from_json(
         {
@@ -65,13 +66,17 @@ def recreate_infrared_project_from_json(infrared_project_json, update_buildings=
             infrared_project_json["buffer"],
             infrared_project_json["snapshot_uuid"],
             infrared_project_json["project_uuid"],
-            update_buildings_at_endpoint=update_buildings
+            update_buildings_at_endpoint=update_buildings,
+            buildings_in_bbox=buildings_in_bbox
             )
 
     return infrared_project
 
 # divides the Grasbrook area into several result tiles (bboxes)
 def get_bboxes(city_pyo_user) -> list:
+    # projects are (re)created from the current project area, never from a cached one
+    cityPyo.invalidate_layers_for_user(city_pyo_user, ["project_area"])
+
     return init_bbox_matrix_for_project_area(city_pyo_user, bbox_size)
 
 
@@ -99,22 +104,47 @@ def create_infrared_project_for_bbox_and_user(infrared_user_json: dict, user_id:
     return infrared_project.export_to_json()
 
 
+# gets the buildings of the cityPyo user once and assigns them to the buffered bboxes of all infrared projects.
+# returns an array with the buildings in bbox for each project
+def get_buildings_for_projects(city_pyo_user: str, infrared_projects_json: list) -> list:
+    buildings_gdf = make_gdf_from_geojson(cityPyo.get_buildings_for_user(city_pyo_user))
+    if buildings_gdf.crs != "EPSG:25832":
+        buildings_gdf = buildings_gdf.to_crs("EPSG:25832")
+
+    buffered_bboxes = [
+        get_buffered_bbox(Polygon(project["bbox_coords"]), project["buffer"]) for project in infrared_projects_json
+    ]
+
+    return partition_buildings_for_bboxes(buffered_bboxes, buildings_gdf)
+
+
 # trigger calculation at AIT infrared endpoint for a infrared_project with given scenario settings and buildings [geojson]
-def start_calculation_for_project(sim_type:str, calc_settings: dict, infrared_project_json: dict):
+# update_buildings can be set to False if the buildings at the endpoint are known to be up to date.
+# buildings_in_bbox can be provided if already known (see get_buildings_for_projects), otherwise they are fetched from cityPyo
+def start_calculation_for_project(sim_type:str, calc_settings: dict, infrared_project_json: dict, update_buildings=True, buildings_in_bbox=None):
     # update buildings at the AIT infrared endpoint
-    infrared_project = recreate_infrared_project_from_json(infrared_project_json, update_buildings=True)
+    infrared_project = recreate_infrared_project_from_json(infrared_project_json, update_buildings, buildings_in_bbox)
     
     # then trigger calculation
     return infrared_project.trigger_calculation_at_endpoint_for(sim_type, calc_settings)
 
 
+# asks the endpoint once for the result of a triggered calculation. Returns None if it is not calculated yet.
+# timeout in seconds for the request, the timeout of the transport if None
+def poll_result_for_project(result_uuid: str, infrared_project_json: dict, timeout=None):
+    infrared_user = create_infrared_user_from_json(infrared_project_json["infrared_client"])
+
+    return get_analysis_output(
+        infrared_user, infrared_project_json["project_uuid"], infrared_project_json["snapshot_uuid"], result_uuid, timeout
+    )
+
+
 # collects the result of a triggered calculation
-def collect_result_for_project(result_uuid: str, infrared_project_json: dict):
+# raw_result is the result as polled from the endpoint (see poll_result_for_project). Polling never blocks here.
+def collect_result_for_project(result_uuid: str, infrared_project_json: dict, raw_result: dict):
     infrared_project = recreate_infrared_project_from_json(infrared_project_json, update_buildings=False)
-    # download and return result
-    geojson = infrared_project.get_result(result_uuid)
 
     return {
-        "geojson": geojson,
+        "grid": infrared_project.get_result_as_grid(raw_result),
         "infrared_project_json": infrared_project_json
     }
\ No newline at end of file
@@ -174,6 +174,17 @@ def query():
                 }
             }
 
+        if "createNewBuilding" in query or "deleteBuilding" in query:
+            # batched mutations: every field is aliased
+            import re
+            aliases = re.findall(r'(\w+): (createNewBuilding|deleteBuilding)', query)
+            if aliases:
+                return {
+                    "data": {
+                        alias: {"success": True, "uuid": get_random_uuid_id()} for alias, _field in aliases
+                    }
+                }
+
         if "createNewBuilding" in query:
             return {
                 "data": {
@@ -1,33 +1,37 @@
 from string import Template
 import json
-import requests
 import os
-import time
+
+from wind.transport import get_transport
+
+
+# number of mutations packed into one request to AIT
+mutation_batch_size = int(os.getenv("INFRARED_MUTATION_BATCH_SIZE", 50))
 
 
 # returns a query string to create new building in snapshot
 
 # make query to infrared api
-def make_query(query, infrared_user):
+def make_query(query, infrared_user, timeout=None):
     """
         Make query response
         auth token needs to be send as cookie
+        timeout in seconds, the timeout of the transport if None
     """
     # print(query)
 
-    # AIT requested a sleep between the requests. To let their servers breath a bit.
-    time.sleep(0.2)
+    # the transport paces the requests (AIT asked to let their servers breath a bit) and reuses connections
     token_cookie = infrared_user.token
     url = os.getenv("INFRARED_URL") + '/api'
     headers={'Cookie': token_cookie, 'origin': os.getenv('INFRARED_URL')}
-    request = requests.post(url, json={'query': query}, headers=headers)
+    request = get_transport().post(url, json={'query': query}, headers=headers, timeout=timeout)
 
     if request.status_code == 200:
         return request.json()
     if request.status_code == 401:
         # login again (will get a new token cookie) and reperform request
         infrared_user.infrared_user_login()
-        return make_query(query, infrared_user)
+        return make_query(query, infrared_user, timeout)
     else:
         raise Exception("Query failed to run by returning code of {}. URL: {} , Query: {}, Headers: {}".format(
         request.status_code,
@@ -38,6 +42,33 @@ def make_query(query, infrared_user):
       )
 
 
+# packs many mutation fields (e.g. create_building_field) into aliased mutation documents of batch_size fields.
+# returns the result of each field in the order of the fields. None for every field that failed.
+def make_batched_mutation(fields, infrared_user, batch_size=mutation_batch_size) -> list:
+    results = []
+
+    for batch_start in range(0, len(fields), batch_size):
+        batch = fields[batch_start:batch_start + batch_size]
+        aliases = ["op" + str(index) for index in range(len(batch))]
+
+        query = "mutation {\n" + "\n".join(alias + ": " + field for alias, field in zip(aliases, batch)) + "}\n"
+        response = make_query(query, infrared_user)
+
+        # graphql reports errors per field, the first element of the error path is the alias of the field
+        failed_aliases = [error["path"][0] for error in response.get("errors", []) if error.get("path")]
+        if response.get("errors"):
+            print("batched mutation returned errors", response["errors"])
+
+        data = response.get("data") or {}
+        for alias in aliases:
+            if alias in failed_aliases:
+                results.append(None)
+            else:
+                results.append(data.get(alias))
+
+    return results
+
+
 def create_project_query(user_uuid, name, sw_lat, sw_long, bbox_size, resolution):
 
     template = Template(
@@ -93,12 +124,10 @@ def create_test_bld(building, snapshot_uuid):
         "snapshot_uuid": snapshot_uuid
     })
 
-# returns a query string to create new building in snapshot
-def create_building_query(building, snapshot_uuid):
+# returns a mutation field to create new building in snapshot. Can be aliased and batched with other fields.
+def create_building_field(building, snapshot_uuid):
 
-    template = Template("""mutation
-    {
-        createNewBuilding(
+    template = Template("""createNewBuilding(
         use: "$building_use"
         height: $building_height
         category: "site"
@@ -108,7 +137,6 @@ def create_building_query(building, snapshot_uuid):
         success
     uuid
     }
-    }
     """)
 
     return template.safe_substitute({
@@ -316,16 +344,14 @@ def get_geometry_objects_in_snapshot_query(snapshot_uuid):
     return template.safe_substitute({"snapshot_uuid": snapshot_uuid})
 
 
-def delete_building(snapshot_uuid, building_uuid):
-    template = Template("""
-                mutation {
-                  deleteBuilding(
+# returns a mutation field to delete a building in snapshot. Can be aliased and batched with other fields.
+def delete_building_field(snapshot_uuid, building_uuid):
+    template = Template("""deleteBuilding(
                     uuid: "$building_uuid",
                     snapshotUuid: "$snapshot_uuid"
                   ) {
                     success
                   }
-                }
                 """)
 
     return template.safe_substitute({"snapshot_uuid": snapshot_uuid, "building_uuid": building_uuid})
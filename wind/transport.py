@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# AIT requested a pause between the requests. To let their servers breath a bit.
+# The pause is measured between the starts of two requests, so time spent on the wire counts towards it.
+min_request_interval = float(os.getenv("INFRARED_MIN_REQUEST_INTERVAL", 0.2))
+pool_maxsize = int(os.getenv("INFRARED_POOL_MAXSIZE", 10))
+# seconds to wait for AIT to connect and to answer, so a hung request does not block a worker forever
+request_timeout = float(os.getenv("INFRARED_REQUEST_TIMEOUT", 60))
+
+_transport = None
+
+
+class InfraredTransport:
+    """Class to handle the HTTP connection to the Infrared endpoint
+        - keeps a pooled keep-alive session (no new TCP/TLS handshake per query)
+        - paces requests, instead of sleeping unconditionally before each one
+        - records how long requests waited for their slot vs. how long they were on the wire
+    """
+    def __init__(self, min_interval=min_request_interval, pool_size=pool_maxsize, timeout=request_timeout):
+        self.pid = os.getpid()
+        self.min_interval = min_interval
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # the auth token is sent explicitly per query. the session must not keep cookies between users.
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+        self.stats = {
+            "requests": 0,
+            "wait_seconds": 0.0,
+            "wire_seconds": 0.0,
+        }
+
+    # blocks until the next request slot is free. returns the time waited in seconds.
+    def wait_for_slot(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    # timeout in seconds, the timeout of the transport if not given
+    def post(self, url, timeout=None, **kwargs) -> requests.Response:
+        kwargs["timeout"] = timeout or self.timeout
+        waited = self.wait_for_slot()
+
+        start = time.monotonic()
+        response = self.session.post(url, **kwargs)
+        on_wire = time.monotonic() - start
+
+        self.record_timing(waited, on_wire)
+
+        return response
+
+    def record_timing(self, waited, on_wire):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["wire_seconds"] += on_wire
+
+    def export_stats(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+# returns the transport owned by this process.
+# celery forks its workers, a session inherited from the parent process must not be reused.
+def get_transport() -> InfraredTransport:
+    global _transport
+
+    if _transport is None or _transport.pid != os.getpid():
+        _transport = InfraredTransport()
+
+    return _transport